@@ -0,0 +1,328 @@
+"""
+Benchmarks the hot paths of narwhal over the test models, at
+several table sizes.
+
+	python3 bench.py
+	python3 bench.py --sizes 1000,100000 --output bench.json
+	python3 bench.py --baseline bench.json
+
+Each size runs in its own process, on a fresh DB, with a fixed
+random seed. Results are printed as JSON: for every size, the
+median seconds per operation of each benchmark (or bytes, for
+memory). Given a baseline produced by a previous run, every
+benchmark that got slower by more than the tolerance is reported,
+and the exit status is 1.
+"""
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+from random import Random
+from statistics import median
+from time import perf_counter
+
+from narwhal.sql import SQL, Query
+
+from test import *
+
+DEFAULT_SIZES	= "1000,10000,100000"
+CREW_PER_VESSEL	= 10
+VESSEL_CLASSES	= 10
+SAMPLE			= 200	# operations timed per benchmark and repeat
+
+def register(db_path:str) -> SQL:
+	SQL.RegisterTypeConversion(
+		Position,
+		adapter 		= Position.SQLAdapter,
+		converter 		= Position.SQLConverter,
+		default 		= Position(),
+		array_adapter	= lambda p : p.pos,
+		array_fields	= ( "lat", "lng" )
+	)
+
+	SQL.RegisterTypeConversion(
+		FloatArray,
+		adapter 		= FloatArray.SQLAdapter,
+		converter 		= FloatArray.SQLConverter,
+		default 		= FloatArray(32),
+		array_adapter	= lambda p : p.array
+	)
+
+	sql = SQL(db_path, use_cache=True)
+	sql.RegisterTables([
+		Crew,
+		VesselClass,
+		Vessel,
+		HistoryString
+	])
+	return sql
+
+def forget(sql:SQL):
+	"""
+	Drops every result kept in memory, so that the next reads go
+	to the DB.
+	"""
+	sql.ClearCache()
+	for sharedmem_type in sql.sharedmemory.values():
+		sharedmem_type.clear()
+	sql.pinned.clear()
+
+def make_crew(rng:Random, i:int) -> Crew:
+	c = Crew()
+	c.name = f"crew {i}"
+	c.rank = rng.choice(( "seaman", "mate", "lieutenant", "captain" ))
+	c.nation = rng.randrange(8)
+	c.health = rng.randrange(100)
+	c.courage = rng.randrange(100)
+	return c
+
+def make_vessel(rng:Random, i:int, vessel_class:VesselClass) -> Vessel:
+	v = Vessel()
+	v.name = f"vessel {i}"
+	v.year = 1700 + rng.randrange(120)
+	v.nation = rng.randrange(8)
+	v.heading = rng.randrange(360)
+	v.speed = rng.uniform(0, 14)
+	v.position_actual = Position.FromTuple(( rng.uniform(-90, 90), rng.uniform(-180, 180) ))
+	v.v_class = vessel_class
+	return v
+
+def populate(sql:SQL, rng:Random, size:int) -> float:
+	"""
+	Fills the DB with size crew, serving on size/CREW_PER_VESSEL vessels.
+	Returns the seconds taken per row.
+	"""
+	classes = []
+	for i in range(VESSEL_CLASSES):
+		vc = VesselClass()
+		vc.name = f"class {i}"
+		vc.masts = 1 + i % 3
+		classes.append(vc)
+	sql.AddList(classes)
+
+	vessels = []
+	crew = [ make_crew(rng, i) for i in range(size) ]
+	for i in range(max(1, size // CREW_PER_VESSEL)):
+		v = make_vessel(rng, i, classes[i % VESSEL_CLASSES])
+		for c in crew[i*CREW_PER_VESSEL:(i+1)*CREW_PER_VESSEL]:
+			v.crew.append(c)
+		vessels.append(v)
+
+	start = perf_counter()
+	sql.AddList(vessels)
+	elapsed = perf_counter() - start
+	forget(sql)
+	return elapsed / ( len(vessels) + len(crew) )
+
+def timed(fn, count:int, repeat:int) -> float:
+	"""
+	Returns the median seconds per operation of fn, which runs
+	count operations.
+	"""
+	times = []
+	for r in range(repeat):
+		start = perf_counter()
+		fn()
+		times.append( ( perf_counter() - start ) / count )
+	return median(times)
+
+def run_size(size:int, repeat:int) -> dict:
+	rng = Random(size)
+	db_dir = tempfile.mkdtemp(prefix="narwhal_bench_")
+	sql = register(os.path.join(db_dir, "bench.db"))
+	results = {}
+
+	results["bulk_insert"] = populate(sql, rng, size)
+	num_vessels = Vessel.Size()
+	num_crew = Crew.Size()
+	sample = min(SAMPLE, num_vessels)
+	new_crew = [ 0 ]
+
+	def insert():
+		for i in range(SAMPLE):
+			new_crew[0] += 1
+			sql.Add(make_crew(rng, size + new_crew[0]))
+	results["insert"] = timed(insert, SAMPLE, repeat)
+
+	def bulk_insert_small():
+		items = []
+		for i in range(SAMPLE):
+			new_crew[0] += 1
+			items.append(make_crew(rng, size + new_crew[0]))
+		sql.AddList(items)
+	results["bulk_insert_200"] = timed(bulk_insert_small, SAMPLE, repeat)
+
+	vessels = Vessel.Select(None, limit=sample)
+	def update():
+		for v in vessels:
+			v.speed = rng.uniform(0, 14)
+			v.Serialize()
+	results["update"] = timed(update, sample, repeat)
+
+	dbids = [ rng.randrange(1, num_crew + 1) for i in range(SAMPLE) ]
+	def point_select():
+		forget(sql)
+		for dbid in dbids:
+			Crew.SelectAtIndex(dbid)
+	results["point_select"] = timed(point_select, SAMPLE, repeat)
+
+	def point_select_warm():
+		for dbid in dbids:
+			Crew.SelectAtIndex(dbid)
+	point_select_warm()
+	results["point_select_warm"] = timed(point_select_warm, SAMPLE, repeat)
+
+	filter_count = 20
+	def filtered_select():
+		forget(sql)
+		for i in range(filter_count):
+			Vessel.Select(
+				Query.And(
+					Query.Equals("nation", i % 8),
+					Query.GreaterThan("speed", 10.0)
+				)
+			)
+	results["filtered_select"] = timed(filtered_select, filter_count, repeat)
+
+	def fresh_vessels() -> list:
+		# objects that are neither cached nor in shared memory,
+		# so their relations haven't been loaded yet
+		forget(sql)
+		return list(Vessel.SelectIter(None, use_sharedmemory=False))[:sample]
+
+	def list_load():
+		for v in loaded:
+			len(v.crew)
+	list_times = []
+	for r in range(repeat):
+		loaded = fresh_vessels()
+		start = perf_counter()
+		list_load()
+		list_times.append( ( perf_counter() - start ) / sample )
+	results["list_load"] = median(list_times)
+
+	def reference_resolution():
+		for v in loaded:
+			v.v_class.name
+	ref_times = []
+	for r in range(repeat):
+		loaded = fresh_vessels()
+		start = perf_counter()
+		reference_resolution()
+		ref_times.append( ( perf_counter() - start ) / sample )
+	results["reference_resolution"] = median(ref_times)
+
+	vessels = Vessel.Select(None, limit=sample)
+	for v in vessels:
+		len(v.crew)
+	def list_append():
+		for v in vessels:
+			new_crew[0] += 1
+			v.crew.append(make_crew(rng, size + new_crew[0]))
+			v.Serialize()
+	results["list_append"] = timed(list_append, sample, repeat)
+
+	def list_remove():
+		for v in vessels:
+			v.crew.remove(v.crew[0])
+			v.Serialize()
+	results["list_remove"] = timed(list_remove, sample, repeat)
+
+	def delete_warm_cache():
+		# warm the cache and shared memory, then delete
+		crew = Crew.Select(None, orderby=Query.OrderDescending("dbid"), limit=sample)
+		Crew.SelectAll()
+		start = perf_counter()
+		for c in crew:
+			c.Delete()
+		return perf_counter() - start
+	results["delete_warm_cache"] = median(
+		[ delete_warm_cache() / sample for r in range(repeat) ]
+	)
+
+	# memory held by the cache and shared memory per row read
+	forget(sql)
+	tracemalloc.start()
+	before = tracemalloc.get_traced_memory()[0]
+	rows = Crew.SelectAll()
+	after = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+	results["bytes_per_cached_row"] = ( after - before ) / max(1, len(rows))
+	results["cache_bytes_per_row"] = sql.CacheSize() / max(1, len(rows))
+
+	sql.connection.close()
+	for name in os.listdir(db_dir):
+		os.remove(os.path.join(db_dir, name))
+	os.rmdir(db_dir)
+	return results
+
+def compare(results:dict, baseline:dict, tolerance:float) -> list:
+	"""
+	Returns a line for every benchmark that's slower (or bigger) than
+	in the baseline by more than tolerance.
+	"""
+	regressions = []
+	for size, benchmarks in results["sizes"].items():
+		base_benchmarks = baseline["sizes"].get(size, {})
+		for name, value in benchmarks.items():
+			base_value = base_benchmarks.get(name)
+			if base_value is None or base_value <= 0:
+				continue
+			ratio = value / base_value
+			if ratio > 1 + tolerance:
+				regressions.append(
+					f"{name} at {size} rows: {value:.3g} vs {base_value:.3g} ({ratio:.2f}x)"
+				)
+	return regressions
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmarks narwhal over the test models.")
+	parser.add_argument("--sizes", default=DEFAULT_SIZES, help="comma-separated numbers of crew rows")
+	parser.add_argument("--repeat", type=int, default=3, help="repeats of each benchmark")
+	parser.add_argument("--output", help="file to write the results to")
+	parser.add_argument("--baseline", help="results of a previous run to compare against")
+	parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown, e.g. 0.25 for 25%%")
+	parser.add_argument("--size", type=int, help=argparse.SUPPRESS)
+	args = parser.parse_args()
+
+	if args.size is not None:
+		# a single size, run by the parent process
+		print(json.dumps(run_size(args.size, args.repeat)))
+		return
+
+	results = {
+		"python"	: platform.python_version(),
+		"sqlite"	: sqlite3.sqlite_version,
+		"platform"	: platform.platform(),
+		"repeat"	: args.repeat,
+		"sizes"		: {}
+	}
+	for size in args.sizes.split(","):
+		output = subprocess.run(
+			[ sys.executable, __file__, "--size", size, "--repeat", str(args.repeat) ],
+			check=True, capture_output=True, text=True
+		).stdout
+		results["sizes"][size] = json.loads(output.strip().splitlines()[-1])
+
+	text = json.dumps(results, indent=4)
+	print(text)
+	if args.output is not None:
+		with open(args.output, "w") as f:
+			f.write(text)
+
+	if args.baseline is not None:
+		with open(args.baseline) as f:
+			baseline = json.load(f)
+		regressions = compare(results, baseline, args.tolerance)
+		for line in regressions:
+			print(f"REGRESSION: {line}", file=sys.stderr)
+		if len(regressions) > 0:
+			sys.exit(1)
+
+if __name__ == '__main__':
+	main()
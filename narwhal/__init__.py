@@ -1 +1 @@
-__all__ = ["sql", "relations", "db"]
\ No newline at end of file
+__all__ = ["sql", "relations", "db", "cache", "diagnostics", "metrics", "aio", "parallel", "shards"]
\ No newline at end of file
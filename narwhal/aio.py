@@ -0,0 +1,189 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from .sql import SQL
+from .shards import ShardedSQL
+
+class AsyncSQL:
+	"""
+	asyncio facade of SQL. Each call runs on a dedicated thread
+	pool, so queries and writes don't block the event loop:
+
+	db = AsyncSQL(SQL("test.db", use_cache=True, pool=True))
+	vessels = await db.Select(Vessel, Query.GreaterThan("speed", 10))
+	async for crew in db.Iter(Crew, None):
+		...
+
+	Results go through the same SQL, so the objects it returns are
+	the same as those returned by synchronous calls.
+
+	The DB should be opened with pool=True, so that the threads can
+	read concurrently. Otherwise its connection can only be used
+	from the thread that opened it, so calls run one at a time on a
+	single thread, through a twin of the DB with its own connection
+	(see SQL.Twin), or of each shard of a ShardedSQL. In-memory DBs
+	can't be opened twice, so calls on them run on the event loop
+	instead, with a warning.
+
+	Arguments:
+
+	sql				-- The SQL to use (default: SQL.Get()).
+	max_workers		-- Number of threads running statements.
+	max_concurrency	-- Maximum number of calls in flight at once (default:
+					   max_workers). Calls beyond that wait their turn
+					   without occupying a thread.
+	"""
+	# SQL -> its AsyncSQL
+	INSTANCES = {}
+
+	sql				: SQL
+	executor		: ThreadPoolExecutor
+	max_concurrency	: int
+	semaphores		: dict		# event loop -> asyncio.Semaphore
+
+	def __init__(self, sql=None, max_workers=4, max_concurrency=None):
+		self.sql = sql if sql is not None else SQL.Get()
+		self.executor = None
+		if self.sql.pool:
+			self.executor = ThreadPoolExecutor(
+				max_workers=max_workers, thread_name_prefix="narwhal"
+			)
+		elif all( shard.db_path != ":memory:" for shard in AsyncSQL.Shards(self.sql) ):
+			max_workers = 1
+			self.executor = ThreadPoolExecutor(
+				max_workers=1, thread_name_prefix="narwhal", initializer=self.sql.Twin
+			)
+		else:
+			print("WARNING: AsyncSQL runs on the event loop, since an in-memory DB can't be opened from another thread!")
+		self.max_concurrency = max_concurrency if max_concurrency is not None else max_workers
+		self.semaphores = {}
+		AsyncSQL.INSTANCES[self.sql] = self
+
+	def Get():
+		"""
+		Returns the AsyncSQL of the default DB, creating it if needed.
+		"""
+		return AsyncSQL.Of(SQL.Get())
+
+	def For(data_class:type):
+		"""
+		Returns the AsyncSQL of the DB that holds the table of a
+		class (see SQL.For), creating it if needed.
+		"""
+		return AsyncSQL.Of(SQL.For(data_class))
+
+	def Shards(sql) -> list:
+		if isinstance(sql, ShardedSQL):
+			return sql.shards
+		return [ sql ]
+
+	def Of(sql):
+		facade = AsyncSQL.INSTANCES.get(sql)
+		if facade is None:
+			facade = AsyncSQL(sql)
+		return facade
+
+	def Close(self):
+		"""
+		Shuts the thread pool down, once the pending calls are done.
+		"""
+		if self.executor is not None:
+			self.executor.shutdown(wait=True)
+
+	async def Run(self, fn, *args, **kwargs):
+		"""
+		Runs fn(*args, **kwargs) on the thread pool, and returns its result.
+		Use it to run a whole transaction at once:
+
+		def Promote(crew):
+			with SQL.Get().Transaction():
+				...
+		await db.Run(Promote, crew)
+
+		fn should get the DB from SQL.Get or SQL.For, which return its
+		twin on the thread pool if it isn't pooled.
+		"""
+		if self.executor is None:
+			return fn(*args, **kwargs)
+		loop = asyncio.get_running_loop()
+		semaphore = self.semaphores.get(loop)
+		if semaphore is None:
+			semaphore = asyncio.Semaphore(self.max_concurrency)
+			self.semaphores[loop] = semaphore
+		async with semaphore:
+			return await loop.run_in_executor(self.executor, partial(fn, *args, **kwargs))
+
+	async def Select(self, data_class:type, args:tuple, orderby="", **kwargs) -> list:
+		return await self.Run(AsyncSQL.Call, self.sql, "Select", data_class, args, orderby, **kwargs)
+
+	async def SelectOne(self, data_class:type, args:tuple) -> object:
+		return await self.Run(AsyncSQL.Call, self.sql, "SelectOne", data_class, args)
+
+	async def SelectAll(self, data_class:type, **kwargs) -> list:
+		return await self.Run(AsyncSQL.Call, self.sql, "SelectAll", data_class, **kwargs)
+
+	async def SelectAtIndex(self, data_class:type, index:int) -> object:
+		return await self.Run(AsyncSQL.Call, self.sql, "SelectAtIndex", data_class, index)
+
+	async def Count(self, data_class:type, args:tuple) -> int:
+		return await self.Run(AsyncSQL.Call, self.sql, "Count", data_class, args)
+
+	async def ToArrays(self, data_class:type, args:tuple, columns=None, orderby="") -> dict:
+		return await self.Run(AsyncSQL.Call, self.sql, "ToArrays", data_class, args, columns, orderby)
+
+	async def Add(self, item, commit=True):
+		await self.Run(AsyncSQL.Call, self.sql, "Add", item, commit)
+
+	async def AddList(self, i_list:list, commit=True):
+		await self.Run(AsyncSQL.Call, self.sql, "AddList", i_list, commit)
+
+	async def Update(self, item, force_update=False, commit=True):
+		await self.Run(AsyncSQL.Call, self.sql, "Update", item, force_update, commit)
+
+	async def Delete(self, item, force_remove=False, commit=True):
+		await self.Run(AsyncSQL.Call, self.sql, "Delete", item, force_remove, commit)
+
+	async def BulkImport(self, data_class:type, source) -> range:
+		return await self.Run(AsyncSQL.Call, self.sql, "BulkImport", data_class, source)
+
+	async def Iter(self, data_class:type, args, orderby="", batch_size=SQL.ITER_BATCH):
+		"""
+		Selects data from the DB, and yields the objects one by one.
+		Rows are fetched batch_size at a time, as pages of a Pager,
+		so that each batch can be read on any thread of the pool.
+
+		Arguments:
+
+		args 		-- Produced by chaining Query functions, or None to
+					   select all rows.
+		orderby		-- Produced by chaining Query.Order* functions.
+		batch_size	-- Number of rows fetched at once.
+		"""
+		# pages aren't cached, see Pager
+		pager = await self.Run(AsyncSQL.Call, self.sql, "Paginate", data_class, args, orderby, batch_size)
+		while True:
+			page = await self.Run(pager.NextPage)
+			if len(page) == 0:
+				return
+			for item in page:
+				yield item
+
+	def Call(sql, method:str, *args, **kwargs):
+		"""
+		Calls a method of sql, or of its twin on the current thread.
+		"""
+		return getattr(SQL.Local(sql), method)(*args, **kwargs)
+
+	async def Load(self, item, name:str):
+		"""
+		Loads the Reference or List name of item, and returns it.
+		"""
+		return await self.Run(AsyncSQL.LoadRelation, item, name)
+
+	def LoadRelation(item, name:str):
+		value = getattr(item, name)
+		if hasattr(value, "__check_loaded__"):
+			# Lists load their items when first accessed
+			value.__check_loaded__()
+		return value
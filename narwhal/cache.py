@@ -0,0 +1,233 @@
+import sys
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from time import monotonic
+
+def ObjectSize(obj) -> int:
+	"""
+	Estimates the size of an object along with its attributes.
+	"""
+	sz = sys.getsizeof(obj)
+	if hasattr(obj, "__dict__"):
+		idict = obj.__dict__
+		sz += sys.getsizeof(idict)
+		for value in idict.values():
+			sz += sys.getsizeof(value)
+	return sz
+
+def EstimateSize(key, value) -> int:
+	"""
+	Estimates the memory held by a cache entry. Results of
+	queries are either a single object or a list of objects.
+	"""
+	sz = sys.getsizeof(key)
+	if type(value) == list:
+		sz += sys.getsizeof(value)
+		for item in value:
+			sz += ObjectSize(item)
+	else:
+		sz += ObjectSize(value)
+	return sz
+
+
+class QueryCache(ABC):
+	"""
+	Interface of the query cache used by SQL. Pass an instance
+	to SQL(..., cache=) to plug in your own implementation.
+
+	Each entry is tagged with the tables its query read. Every
+	table has a generation counter that SQL bumps through 
+	Invalidate whenever the table is written to, and an entry is
+	only valid while the generations of its tables are unchanged.
+
+	Implementations must define Get, Put, Discard, Items, Clear,
+	Size and __len__. They may be used from several threads at once,
+	and should hold lock while they change their state.
+	"""
+	hits		: int
+	misses		: int
+	evictions	: int
+	generations	: dict	# table name -> generation
+	lock		: threading.RLock
+
+	def __init__(self):
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.generations = {}
+		self.lock = threading.RLock()
+
+	def Invalidate(self, table:str):
+		"""
+		Invalidates every cached result that read from table.
+		"""
+		with self.lock:
+			self.generations[table] = self.generations.get(table, 0) + 1
+
+	def Generations(self, tables:tuple) -> tuple:
+		"""
+		Returns the current generations of tables.
+		"""
+		generations = self.generations
+		return tuple( generations.get(table, 0) for table in tables )
+
+	@abstractmethod
+	def Get(self, key):
+		"""
+		Returns the value stored for key, or None if it isn't cached.
+		"""
+		raise NotImplementedError
+
+	@abstractmethod
+	def Put(self, key, value, tables:tuple=(), generations=None):
+		"""
+		Stores the result of a query that read from tables. If the
+		generations of the tables taken before the query ran are given,
+		and they've changed since, the result may already be out of 
+		date, and isn't stored.
+		"""
+		raise NotImplementedError
+
+	@abstractmethod
+	def Discard(self, key):
+		raise NotImplementedError
+
+	@abstractmethod
+	def Items(self) -> list:
+		"""
+		Returns a list of ( key, value ) pairs of the cache.
+		"""
+		raise NotImplementedError
+
+	@abstractmethod
+	def Clear(self):
+		raise NotImplementedError
+
+	@abstractmethod
+	def Size(self) -> int:
+		"""
+		Returns the estimated number of bytes held by the cache.
+		"""
+		raise NotImplementedError
+
+	@abstractmethod
+	def __len__(self) -> int:
+		raise NotImplementedError
+
+	def Stats(self) -> dict:
+		return {
+			"entries"	: len(self),
+			"bytes"		: self.Size(),
+			"hits"		: self.hits,
+			"misses"	: self.misses,
+			"evictions"	: self.evictions
+		}
+
+
+class LRUCache(QueryCache):
+	"""
+	Query cache that evicts the least recently used entries once
+	it holds more than max_entries, or more than max_bytes.
+
+	Arguments:
+
+	max_entries	-- maximum number of cached queries (None for no limit)
+	max_bytes	-- maximum estimated size of the cache (None for no limit)
+	ttl			-- optional dict of table name -> seconds after which
+				   the results of queries on the table expire
+	default_ttl	-- seconds after which results of queries on other
+				   tables expire (None to never expire)
+	"""
+	DEFAULT_ENTRIES = 10000
+	DEFAULT_BYTES 	= 64 * 1024 * 1024
+
+	entries		: OrderedDict	# key -> ( value, size, expiry, tables, generations )
+	resident	: int
+
+	def __init__(self, max_entries=DEFAULT_ENTRIES, max_bytes=DEFAULT_BYTES, ttl=None, default_ttl=None):
+		super().__init__()
+		self.max_entries = max_entries
+		self.max_bytes = max_bytes
+		self.ttl = ttl if ttl is not None else {}
+		self.default_ttl = default_ttl
+		self.entries = OrderedDict()
+		self.resident = 0
+
+	def Expiry(self, tables:tuple):
+		"""
+		Returns the time at which a result read from tables expires,
+		or None if it doesn't.
+		"""
+		expiry = None
+		for table in tables:
+			ttl = self.ttl.get(table, self.default_ttl)
+			if ttl is not None:
+				t = monotonic() + ttl
+				if expiry is None or t < expiry:
+					expiry = t
+		return expiry
+
+	def Get(self, key):
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry is None:
+				self.misses += 1
+				return None
+			if ( entry[2] is not None and monotonic() > entry[2] ) or \
+				self.Generations(entry[3]) != entry[4]:
+				# expired, or a table it read has been written to since
+				self.Discard(key)
+				self.misses += 1
+				return None
+			self.entries.move_to_end(key)
+			self.hits += 1
+			return entry[0]
+
+	def Put(self, key, value, tables:tuple=(), generations=None):
+		size = EstimateSize(key, value)
+		with self.lock:
+			current = self.Generations(tables)
+			if generations is not None and generations != current:
+				# a table was written to while the query ran
+				return
+			self.Discard(key)
+			self.entries[key] = ( 
+				value, size, self.Expiry(tables), tables, current
+			)
+			self.resident += size
+			self.Evict()
+
+	def Evict(self):
+		"""
+		Drops the least recently used entries until we're within budget.
+		"""
+		entries = self.entries
+		while len(entries) > 0 and (
+			( self.max_entries is not None and len(entries) > self.max_entries ) or
+			( self.max_bytes is not None and self.resident > self.max_bytes )
+		):
+			key, entry = entries.popitem(last=False)
+			self.resident -= entry[1]
+			self.evictions += 1
+
+	def Discard(self, key):
+		with self.lock:
+			entry = self.entries.pop(key, None)
+			if entry is not None:
+				self.resident -= entry[1]
+
+	def Items(self) -> list:
+		with self.lock:
+			return [ ( key, entry[0] ) for key, entry in self.entries.items() ]
+
+	def Clear(self):
+		with self.lock:
+			self.entries = OrderedDict()
+			self.resident = 0
+
+	def Size(self) -> int:
+		return self.resident
+
+	def __len__(self) -> int:
+		return len(self.entries)
@@ -2,6 +2,7 @@ from typing import get_origin, get_args
 
 from .sql import SQL, SQLBaseType
 from .relations import Reference, List
+from .aio import AsyncSQL
 
 class DBObject(SQLBaseType):
 	SPECIAL_TYPES 	= [ Reference, List ]
@@ -21,7 +22,7 @@ class DBObject(SQLBaseType):
 				if origin == List:
 					self.__dict__[item_name].set_parent_child(self, child_dc, item_name)
 				else: # Reference
-					self.__dict__[item_name].set_childtype(child_dc)
+					self.__dict__[item_name].set_childtype(child_dc, self.__class__)
 
 	def __init__(self):
 		self.__initialize_relations__()
@@ -55,16 +56,32 @@ class DBObject(SQLBaseType):
 	def __setattr__(self, name: str, value):
 		# make sure reference setters set the reference 
 		annotations = object.__getattribute__(self, "__annotations__")
-		#annotations = self.__annotations__
+		idict =  object.__getattribute__(self, "__dict__")
 		if name in annotations:
 			item_type = annotations[name]
 			origin = get_origin(item_type)
 			if origin in DBObject.SPECIAL_TYPES:
 				# calls special set function for both reference & list
-				idict =  object.__getattribute__(self, "__dict__")
 				idict[name].__set__(value)
+				if origin == Reference:
+					self.__mark_dirty__(name)
 				return
 		super().__setattr__(name, value)
+		self.__mark_dirty__(name)
+
+	def __mark_dirty__(self, name:str):
+		# record that a column must be written on the next update
+		dirty = object.__getattribute__(self, "__dict__").get("__dirty__")
+		if dirty is not None:
+			dirty.add(name)
+
+	def __set_column__(self, name:str, value):
+		# for db use, when we need to set a column that isn't
+		# an attribute, e.g. the columns of a List
+		idict = object.__getattribute__(self, "__dict__")
+		if name not in idict or idict[name] != value:
+			idict[name] = value
+			self.__mark_dirty__(name)
 	
 	def __get_reference__(self, name:str):
 		# for db use, when we need to access the underlying reference
@@ -86,14 +103,8 @@ class DBObject(SQLBaseType):
 				idict =  object.__getattribute__(self, "__dict__")
 				idict[name] = value
 
-	def __del__(self):
-		""" Try to free the object's allocation
-			in shared memory, if it exists there.
-		"""
-		SQL.Get().__mark_deleted__(self)
-
 	def Serialize(self, force_update=False):
-		sql = SQL.Get()
+		sql = SQL.For(self.__class__)
 		idict = object.__getattribute__(self, "__dict__")
 		if "dbid" in idict.keys():
 			sql.Update(self, force_update)
@@ -101,41 +112,110 @@ class DBObject(SQLBaseType):
 			sql.Add(self)
 	
 	def Delete(self, force_remove=False):
-		sql = SQL.Get()
+		sql = SQL.For(self.__class__)
 		idict = object.__getattribute__(self, "__dict__")
 		if "dbid" in idict.keys():
 			sql.Delete(self, force_remove=force_remove)
 
+	async def ASerialize(self, force_update=False):
+		await AsyncSQL.For(self.__class__).Run(self.Serialize, force_update)
+
+	async def ADelete(self, force_remove=False):
+		await AsyncSQL.For(self.__class__).Run(self.Delete, force_remove)
+
+	async def ALoad(self, name:str):
+		return await AsyncSQL.For(self.__class__).Load(self, name)
+
 	def __eq__(self, obj) -> bool:
-		return (type(self) == type(obj)) and (self.dbid == obj.dbid)
+		if type(self) != type(obj):
+			return False
+		idict = object.__getattribute__(self, "__dict__")
+		odict = object.__getattribute__(obj, "__dict__")
+		if "dbid" not in idict or "dbid" not in odict:
+			# rows not yet in the DB are only equal to themselves
+			return self is obj
+		return idict["dbid"] == odict["dbid"]
+
+	@classmethod
+	def Select(cls, args:tuple, orderby="", prefetch=(), 
+		limit=None, offset=None, after_dbid=None, after=None, columns=None, use_cache=True) -> list:
+		return SQL.For(cls).Select(
+			cls, args, orderby, prefetch=prefetch, 
+			limit=limit, offset=offset, after_dbid=after_dbid, after=after,
+			columns=columns, use_cache=use_cache
+		)
+
+	@classmethod
+	def Paginate(cls, args=None, orderby="", page_size=100, after=None):
+		return SQL.For(cls).Paginate(cls, args, orderby, page_size, after)
+
+	@classmethod
+	def SelectIter(cls, args:tuple, orderby="", batch_size=SQL.ITER_BATCH, 
+		use_sharedmemory=True, prefetch=(), columns=None):
+		return SQL.For(cls).SelectIter(
+			cls, args, orderby, batch_size, use_sharedmemory, prefetch, columns
+		)
 
 	@classmethod
-	def Select(cls, args:tuple, orderby="") -> list:
-		return SQL.Get().Select(cls, args, orderby)
+	def SelectAllIter(cls, batch_size=SQL.ITER_BATCH, use_sharedmemory=True, prefetch=(),
+		columns=None):
+		return SQL.For(cls).SelectAllIter(cls, batch_size, use_sharedmemory, prefetch, columns)
 
 	@classmethod
 	def SelectOne(cls, args:tuple) -> object:
-		return SQL.Get().SelectOne(cls, args)
+		return SQL.For(cls).SelectOne(cls, args)
 
 	@classmethod
-	def SelectAll(cls) -> list:
-		return SQL.Get().SelectAll(cls)
+	def BulkImport(cls, source) -> range:
+		return SQL.For(cls).BulkImport(cls, source)
+
+	@classmethod
+	def ToArrays(cls, args:tuple, columns=None, orderby="", batch_size=SQL.ITER_BATCH) -> dict:
+		return SQL.For(cls).ToArrays(cls, args, columns, orderby, batch_size)
+
+	@classmethod
+	def SelectAll(cls, prefetch=(), columns=None) -> list:
+		return SQL.For(cls).SelectAll(cls, prefetch=prefetch, columns=columns)
 
 	@classmethod
 	def SelectAtIndex(cls, index:int) -> object:
-		return SQL.Get().SelectAtIndex(cls, index)
+		return SQL.For(cls).SelectAtIndex(cls, index)
 
 	@classmethod
 	def SelectRandom(cls, num=1):
-		return SQL.Get().SelectRandom(cls, num)
+		return SQL.For(cls).SelectRandom(cls, num)
 
 	@classmethod
 	def Count(cls, args:tuple) -> int:
-		return SQL.Get().Count(cls, args)
+		return SQL.For(cls).Count(cls, args)
 
 	@classmethod
 	def Size(cls) -> int:
-		return SQL.Get().TableLength(cls)
+		return SQL.For(cls).TableLength(cls)
+
+	@classmethod
+	async def ASelect(cls, args:tuple, orderby="", **kwargs) -> list:
+		return await AsyncSQL.For(cls).Select(cls, args, orderby, **kwargs)
+
+	@classmethod
+	async def ASelectOne(cls, args:tuple) -> object:
+		return await AsyncSQL.For(cls).SelectOne(cls, args)
+
+	@classmethod
+	async def ASelectAll(cls, **kwargs) -> list:
+		return await AsyncSQL.For(cls).SelectAll(cls, **kwargs)
+
+	@classmethod
+	async def ASelectAtIndex(cls, index:int) -> object:
+		return await AsyncSQL.For(cls).SelectAtIndex(cls, index)
+
+	@classmethod
+	async def ACount(cls, args:tuple) -> int:
+		return await AsyncSQL.For(cls).Count(cls, args)
+
+	@classmethod
+	def AIter(cls, args, orderby="", batch_size=SQL.ITER_BATCH):
+		return AsyncSQL.For(cls).Iter(cls, args, orderby, batch_size)
 
 
 
@@ -0,0 +1,166 @@
+import re
+import threading
+from functools import lru_cache
+
+# runs of placeholders, e.g. the values of an IN (...) list
+PLACEHOLDERS = re.compile(r"\?(\s*,\s*\?)+")
+WHITESPACE = re.compile(r"\s+")
+SCAN = re.compile(r"^SCAN (?:TABLE )?(\w+)")
+
+@lru_cache(maxsize=4096)
+def StatementShape(cmd:str) -> str:
+	"""
+	Normalizes a statement, so that statements which only differ
+	by the number of values they're given have the same shape.
+	"""
+	shape = WHITESPACE.sub(" ", cmd.strip())
+	return PLACEHOLDERS.sub("?, ...", shape)
+
+
+class StatementStats:
+	"""
+	What we know about the statements of a single shape.
+	"""
+	shape		: str
+	plan		: list		# details of the steps of EXPLAIN QUERY PLAN
+	scans		: list		# names of the large tables scanned by the plan
+	calls		: int
+	total_time	: float		# seconds
+
+	def __init__(self, shape:str, plan:list, scans:list):
+		self.shape = shape
+		self.plan = plan
+		self.scans = scans
+		self.calls = 0
+		self.total_time = 0.0
+
+	def __repr__(self) -> str:
+		return f"StatementStats({self.shape!r}, calls={self.calls}, total_time={self.total_time:.6f})"
+
+
+class Diagnostics:
+	"""
+	Collects the plan, number of calls and total time of every
+	statement shape run by SQL. Enabled with SQL.EnableDiagnostics.
+
+	Each shape is explained once, with the arguments of its first
+	call, on the connection that ran it. Its plan is flagged if it
+	scans a table that held at least large_table rows at the time.
+	Diagnostics has its own lock, so that threads record statements
+	without waiting on the writer.
+
+	Arguments:
+
+	connection	-- The connection used to explain statements which
+				   aren't recorded with their own.
+	large_table	-- Number of rows from which a table counts as large.
+	"""
+	STATEMENTS = ( "select", "update", "delete", "insert" )
+
+	connection	: object
+	large_table	: int
+	statements	: dict		# shape -> StatementStats
+	table_sizes	: dict		# table name -> number of rows
+	lock		: threading.Lock
+
+	def __init__(self, connection, large_table=1000):
+		self.connection = connection
+		self.large_table = large_table
+		self.statements = {}
+		self.table_sizes = {}
+		self.lock = threading.Lock()
+
+	def Record(self, cmd:str, args, elapsed:float, many=False, connection=None):
+		"""
+		Records a call of a statement that took elapsed seconds.
+		A new shape is explained on connection, the one that ran it.
+		"""
+		shape = StatementShape(cmd)
+		with self.lock:
+			stats = self.statements.get(shape)
+		if stats is None:
+			if many:
+				args = next(iter(args), ())
+			# explain outside the lock, since it runs a statement
+			stats = self.Explain(shape, cmd, args, connection)
+			with self.lock:
+				stats = self.statements.setdefault(shape, stats)
+		with self.lock:
+			stats.calls += 1
+			stats.total_time += elapsed
+
+	def Explain(self, shape:str, cmd:str, args, connection=None) -> StatementStats:
+		if connection is None:
+			connection = self.connection
+		plan = []
+		scans = []
+		if cmd.lstrip()[:6].lower() in Diagnostics.STATEMENTS:
+			cursor = connection.cursor()
+			cursor.row_factory = None
+			try:
+				cursor.execute(f"explain query plan {cmd}", args)
+				plan = [ row[3] for row in cursor.fetchall() ]
+			except Exception as e:
+				plan = [ f"couldn't explain: {e}" ]
+			cursor.close()
+			for detail in plan:
+				match = SCAN.match(detail)
+				if match is not None and self.TableSize(match.group(1), connection) >= self.large_table:
+					scans.append(match.group(1))
+		return StatementStats(shape, plan, scans)
+
+	def TableSize(self, table_name:str, connection=None) -> int:
+		if connection is None:
+			connection = self.connection
+		with self.lock:
+			size = self.table_sizes.get(table_name)
+		if size is None:
+			cursor = connection.cursor()
+			cursor.row_factory = None
+			try:
+				cursor.execute(f"select count(1) from {table_name}")
+				size = cursor.fetchone()[0]
+			except Exception:
+				# not a table, e.g. a subquery
+				size = 0
+			cursor.close()
+			with self.lock:
+				self.table_sizes[table_name] = size
+		return size
+
+	def Statements(self) -> list:
+		"""
+		Returns the stats of every statement shape, the most
+		time-consuming first.
+		"""
+		with self.lock:
+			statements = list(self.statements.values())
+		return sorted(statements, key=lambda s : s.total_time, reverse=True)
+
+	def Scans(self) -> list:
+		"""
+		Returns the stats of the statement shapes that scan large tables.
+		"""
+		return [ stats for stats in self.Statements() if len(stats.scans) > 0 ]
+
+	def Report(self) -> str:
+		"""
+		Returns a readable report of every statement shape, the most
+		time-consuming first, flagging those that scan large tables.
+		"""
+		lines = []
+		for stats in self.Statements():
+			flag = ""
+			if len(stats.scans) > 0:
+				flag = f"  ** SCAN of {', '.join(stats.scans)}"
+			lines.append(
+				f"{stats.calls:>8} calls  {stats.total_time:>10.4f} s  {stats.shape}{flag}"
+			)
+			for detail in stats.plan:
+				lines.append(f"{'':>32}{detail}")
+		return "\n".join(lines)
+
+	def Reset(self):
+		with self.lock:
+			self.statements = {}
+			self.table_sizes = {}
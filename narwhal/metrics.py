@@ -0,0 +1,167 @@
+import threading
+from math import ceil
+from collections import deque
+from typing import NamedTuple
+
+class StatementEvent(NamedTuple):
+	"""
+	Reported to the observers of SQL (see SQL.AddObserver) after
+	each operation on the DB.
+	"""
+	operation	: str		# e.g. Select, Add, or Reference/List for lazy relation loads
+	table		: str
+	shape		: str		# the statement, with runs of placeholders collapsed
+	elapsed		: float		# seconds, including any nested operations
+	rows		: int		# rows read or written
+	objects		: int		# objects built from the rows read
+	cache_hit	: object	# True or False, or None if the cache wasn't used
+
+
+class OperationStats:
+	"""
+	Aggregated events of one operation on one table.
+	"""
+	calls		: int
+	total_time	: float
+	rows		: int
+	objects		: int
+	cache_hits	: int
+	cache_misses: int
+	samples		: deque		# elapsed times of the most recent calls
+
+	def __init__(self, max_samples:int):
+		self.calls = 0
+		self.total_time = 0.0
+		self.rows = 0
+		self.objects = 0
+		self.cache_hits = 0
+		self.cache_misses = 0
+		self.samples = deque(maxlen=max_samples)
+
+	def Percentile(self, p:float) -> float:
+		"""
+		Returns the p-th percentile (0-100) of the recent elapsed
+		times, by nearest rank.
+		"""
+		if len(self.samples) == 0:
+			return 0.0
+		ordered = sorted(self.samples)
+		rank = min(len(ordered), max(1, ceil(p / 100 * len(ordered)))) - 1
+		return ordered[rank]
+
+
+class MetricsAggregator:
+	"""
+	Observer that aggregates events by operation and table:
+
+	metrics = MetricsAggregator()
+	sql.AddObserver(metrics)
+	...
+	print(metrics.Percentiles("Select", "vessel_table"))
+	print(metrics.Prometheus())
+
+	Arguments:
+
+	max_samples	-- Number of recent elapsed times kept per operation
+				   and table, from which percentiles are computed.
+
+	It may observe DBs used by several threads: events are aggregated,
+	and reported, under a lock.
+	"""
+	PERCENTILES = ( 50, 90, 99 )
+
+	max_samples	: int
+	stats		: dict		# ( operation, table ) -> OperationStats
+	lock		: threading.Lock
+
+	def __init__(self, max_samples=10000):
+		self.max_samples = max_samples
+		self.stats = {}
+		self.lock = threading.Lock()
+
+	def __call__(self, event:StatementEvent):
+		key = ( event.operation, event.table )
+		with self.lock:
+			stats = self.stats.get(key)
+			if stats is None:
+				stats = OperationStats(self.max_samples)
+				self.stats[key] = stats
+			stats.calls += 1
+			stats.total_time += event.elapsed
+			stats.rows += event.rows
+			stats.objects += event.objects
+			if event.cache_hit is True:
+				stats.cache_hits += 1
+			elif event.cache_hit is False:
+				stats.cache_misses += 1
+			stats.samples.append(event.elapsed)
+
+	def Percentiles(self, operation:str, table:str, percentiles=PERCENTILES) -> dict:
+		"""
+		Returns a dict of percentile -> elapsed seconds.
+		"""
+		with self.lock:
+			stats = self.stats.get( ( operation, table ) )
+			if stats is None:
+				return {}
+			return { p : stats.Percentile(p) for p in percentiles }
+
+	def Summary(self, percentiles=PERCENTILES) -> list:
+		"""
+		Returns one dict per operation and table, the most
+		time-consuming first.
+		"""
+		summary = []
+		with self.lock:
+			for ( operation, table ), stats in self.stats.items():
+				entry = {
+					"operation"		: operation,
+					"table"			: table,
+					"calls"			: stats.calls,
+					"total_time"	: stats.total_time,
+					"rows"			: stats.rows,
+					"objects"		: stats.objects,
+					"cache_hits"	: stats.cache_hits,
+					"cache_misses"	: stats.cache_misses
+				}
+				for p in percentiles:
+					entry[f"p{p}"] = stats.Percentile(p)
+				summary.append(entry)
+		summary.sort(key=lambda entry : entry["total_time"], reverse=True)
+		return summary
+
+	def Prometheus(self, prefix="narwhal", percentiles=PERCENTILES) -> str:
+		"""
+		Returns the metrics in the Prometheus text exposition format.
+		"""
+		lines = [
+			f"# HELP {prefix}_operation_seconds Time spent in operations on the DB.",
+			f"# TYPE {prefix}_operation_seconds summary"
+		]
+		counters = (
+			( "rows", "Rows read or written." ),
+			( "objects", "Objects built from rows." ),
+			( "cache_hits", "Results served from the cache." ),
+			( "cache_misses", "Results not found in the cache." )
+		)
+		with self.lock:
+			items = sorted(self.stats.items())
+			for ( operation, table ), stats in items:
+				labels = f'operation="{operation}",table="{table}"'
+				for p in percentiles:
+					lines.append(
+						f'{prefix}_operation_seconds{{{labels},quantile="{p / 100}"}} {stats.Percentile(p)}'
+					)
+				lines.append(f"{prefix}_operation_seconds_sum{{{labels}}} {stats.total_time}")
+				lines.append(f"{prefix}_operation_seconds_count{{{labels}}} {stats.calls}")
+			for name, help_str in counters:
+				lines.append(f"# HELP {prefix}_{name}_total {help_str}")
+				lines.append(f"# TYPE {prefix}_{name}_total counter")
+				for ( operation, table ), stats in items:
+					labels = f'operation="{operation}",table="{table}"'
+					lines.append(f"{prefix}_{name}_total{{{labels}}} {getattr(stats, name)}")
+		return "\n".join(lines) + "\n"
+
+	def Reset(self):
+		with self.lock:
+			self.stats = {}
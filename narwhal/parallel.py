@@ -0,0 +1,162 @@
+import os
+import multiprocessing
+from functools import reduce as Reduce
+
+from .sql import SQL, Query
+from .shards import ShardedSQL
+
+# state of the scan, inherited by forked workers
+WORKER = {}
+
+def ScanPartition(partition:tuple):
+	"""
+	Runs in a worker: applies the scan function to the rows of one
+	dbid range of a shard.
+	"""
+	data_class = WORKER["data_class"]
+	sql = WORKER.get("sql")
+	if sql is None:
+		# the parent's connections can't be used after a fork,
+		# so bind every class to a read-only copy of its DB
+		copies = {}
+		for registered in SQL.TABLES:
+			SQL.Bind(registered, ReadOnlyCopy(SQL.For(registered), copies))
+		sql = SQL.For(data_class)
+		WORKER["sql"] = sql
+		if WORKER["setup"] is not None:
+			WORKER["setup"]()
+	index, low, high = partition
+	return WORKER["fn"](
+		Shards(sql)[index].SelectIter(
+			data_class,
+			PartitionQuery(WORKER["args"], ( low, high )),
+			batch_size=WORKER["batch_size"],
+			use_sharedmemory=False
+		)
+	)
+
+def ReadOnlyCopy(sql, copies:dict):
+	"""
+	Opens sql again, read-only, or each of its shards if it's sharded.
+	In-memory DBs can't be opened again, so they're kept.
+	"""
+	copy = copies.get(id(sql))
+	if copy is None:
+		if isinstance(sql, ShardedSQL):
+			copy = ShardedSQL([ ReadOnlyCopy(shard, copies) for shard in sql.shards ])
+			copy.tables = sql.tables
+		elif sql.db_path == ":memory:":
+			copy = sql
+		else:
+			copy = SQL(sql.db_path, read_only=True)
+			copy.OpenTables(sql.tables)
+		copies[id(sql)] = copy
+	return copy
+
+def Shards(sql) -> list:
+	if isinstance(sql, ShardedSQL):
+		return sql.shards
+	return [ sql ]
+
+def PartitionQuery(args, bounds:tuple):
+	partition = Query.Between("dbid", bounds[0], bounds[1])
+	if args is None:
+		return partition
+	return Query.And(args, partition)
+
+def Partitions(sql, data_class:type, count:int) -> list:
+	"""
+	Splits the dbids of a table into about count contiguous ranges,
+	as ( shard index, lowest dbid, highest dbid ).
+	"""
+	shards = Shards(sql)
+	per_shard = max(1, count // len(shards))
+	partitions = []
+	for index, shard in enumerate(shards):
+		cursor = shard.__reader__().cursor()
+		cursor.execute(f"select min(dbid), max(dbid) from {data_class.__tablename__}")
+		low, high = cursor.fetchone()
+		cursor.close()
+		if low is None:
+			continue
+		size = max(1, -(-(high - low + 1) // per_shard))
+		partitions += [
+			( index, start, min(high, start + size - 1) ) for start in range(low, high + 1, size)
+		]
+	return partitions
+
+def ParallelScan(data_class:type, args, fn, workers=None, reduce=None, initial=None,
+	setup=None, partitions_per_worker=4, batch_size=SQL.ITER_BATCH) -> object:
+	"""
+	Scans the rows of a table that satisfy a query on several
+	processes at once. The table is split into ranges of dbids, and
+	fn is called on each range, in a worker process, with an iterator
+	over its objects. The results of fn are combined with reduce,
+	or returned as a list in dbid order if reduce is None:
+
+	total_courage = ParallelScan(
+		Crew, None,
+		lambda crew : sum( c.courage for c in crew ),
+		reduce=operator.add
+	)
+
+	Workers are forked, so fn may be a lambda, but its results must
+	be picklable. Each worker reads through its own read-only
+	connection, so writes that haven't been committed aren't seen,
+	and objects aren't shared with the caller's shared memory.
+	The shards of a sharded table are scanned in parallel too.
+	In-memory DBs, and platforms that can't fork, are scanned serially.
+
+	Arguments:
+
+	args					-- Produced by chaining Query functions, or
+							   None to scan all rows.
+	fn						-- Called with an iterator over the objects of
+							   each partition.
+	workers					-- Number of processes (default: one per CPU).
+	reduce					-- Combines the results of two partitions.
+	initial					-- Returned if the table has no rows.
+	setup					-- Called once in each worker, before scanning.
+	partitions_per_worker	-- Ranges scanned by each worker, to balance
+							   the work between them.
+	batch_size				-- Number of rows fetched at once.
+	"""
+	sql = SQL.For(data_class)
+	if workers is None:
+		workers = os.cpu_count() or 1
+
+	context = None
+	if any( shard.db_path == ":memory:" for shard in Shards(sql) ):
+		if workers > 1:
+			print("WARNING: an in-memory DB can't be scanned in parallel!")
+	elif workers > 1:
+		try:
+			context = multiprocessing.get_context("fork")
+		except ValueError:
+			print("WARNING: can't fork worker processes, so the DB is scanned serially!")
+
+	if context is None:
+		results = [
+			fn(sql.SelectIter(data_class, args, batch_size=batch_size, use_sharedmemory=False))
+		]
+	else:
+		partitions = Partitions(sql, data_class, workers * partitions_per_worker)
+		WORKER.clear()
+		WORKER.update(
+			data_class	= data_class,
+			args		= args,
+			fn			= fn,
+			setup		= setup,
+			batch_size	= batch_size
+		)
+		try:
+			with context.Pool(min(workers, max(1, len(partitions)))) as pool:
+				results = pool.map(ScanPartition, partitions, chunksize=1)
+		finally:
+			WORKER.clear()
+
+	if reduce is None:
+		return results
+	if len(results) == 0:
+		return initial
+	return Reduce(reduce, results)
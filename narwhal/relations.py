@@ -8,46 +8,77 @@ class Reference(Generic[T]):
 	__sql_type__ = "integer"
 
 	child_dc 	: type
+	parent_dc	: type
 	ref_id 		: int
 	cached		: object
 	initialized	: bool
+	prefetched	: bool
 
 	def __sql_adapter__(self):
 		if self.ref_id == NULL_INT:
-			if self.cached != None:
-				# Add it if it hasn't already
-				SQL.Get().Add(self.cached, commit=False)
+			if self.cached is not None:
+				# Add it if it hasn't already. The DB of the parent commits
+				# it along with the parent, unless it's in another DB
+				sql = SQL.For(self.child_dc)
+				in_other_db = self.parent_dc is not None and sql is not SQL.For(self.parent_dc)
+				sql.Add(self.cached, commit=in_other_db)
 				self.ref_id = self.cached.dbid
+			else:
+				# store null, which satisfies the foreign key
+				return None
 		return self.ref_id
 
 	def __sql_converter__(self, i):
+		if i is None:
+			i = NULL_INT
+		if i != self.ref_id:
+			self.cached = None
+			self.prefetched = False
 		self.ref_id = i
 
-	def set_childtype(self, child_dc:type):
+	def set_childtype(self, child_dc:type, parent_dc=None):
 		self.child_dc = child_dc
+		self.parent_dc = parent_dc
 
 	def __init__(self):
+		self.parent_dc = None
 		self.ref_id = NULL_INT
 		self.cached = None
 		self.initialized = False
+		self.prefetched = False
 
 	def __set__(self, obj):
-		if obj != None:
+		if obj is not None:
 			assert(type(obj) == self.child_dc)
-			self.ref_id = obj.dbid
+			self.ref_id = obj.__dict__.get("dbid", NULL_INT)
 		else:
 			self.ref_id = NULL_INT
 		self.cached = obj
+		self.prefetched = False
+
+	def __is_current__(self) -> bool:
+		# whether the cached object can be returned without a query
+		return self.prefetched or (self.child_dc.__immutable__ and self.cached is not None)
+
+	def __prefetched__(self, obj):
+		# set by SQL.Prefetch, which loaded obj along with other references
+		self.cached = obj
+		self.prefetched = True
 
 	def __get__(self):
 		if self.ref_id != NULL_INT:
-			if self.child_dc.__immutable__ and self.cached != None:
-				return self.cached
-			#dc = get_args(self.__orig_class__)[0]
-			self.cached = SQL.Get().SelectAtIndex(
-				self.child_dc,
-				self.ref_id
-			)
+			if self.prefetched:
+				# serve the prefetched object once; after that,
+				# mutable objects are fetched again as usual
+				self.prefetched = False
+			elif not self.__is_current__():
+				#dc = get_args(self.__orig_class__)[0]
+				sql = SQL.For(self.child_dc)
+				with sql.__labeled__("Reference"):
+					self.cached = sql.SelectAtIndex(
+						self.child_dc,
+						self.ref_id
+					)
 		self.initialized = True
 		return self.cached
 
@@ -67,10 +98,9 @@ class List(Generic[T]):
 		id = SQL.MakeListID( SQL.ListIdentifier(parent_dc, var_name) )
 		parent_dbid = child.__dict__[id]
 		if parent_dbid != NULL_INT:
-			return SQL.Get().SelectOne(
-				parent_dc,
-				Query.Equals("dbid", parent_dbid)
-			)
+			sql = SQL.For(parent_dc)
+			with sql.__labeled__("ReverseLookup"):
+				return sql.SelectAtIndex(parent_dc, parent_dbid)
 		return None
 
 	def __init__(self):
@@ -99,14 +129,28 @@ class List(Generic[T]):
 			if not self.initialized:
 				self.__validate_parent__()
 				#dc = get_args(self.__orig_class__)[0]
-				sql = SQL.Get()
-				self.items = sql.Select(
-					self.child_dc,
-					Query.Equals(self.id_key, self.parent.dbid),
-					Query.OrderAscending(self.order_key)
-				)		
+				sql = SQL.For(self.child_dc)
+				with sql.__labeled__("List"):
+					self.items = sql.Select(
+						self.child_dc,
+						Query.Equals(self.id_key, self.parent.dbid),
+						Query.OrderAscending(self.order_key)
+					)
 				self.initialized = True
 
+	def __set_loaded__(self, items:list):
+		# set by SQL.Prefetch, which loaded the items of many lists at once
+		self.items = items
+		self.initialized = True
+
+	@classmethod
+	def PrefetchFor(cls, parents:list, var_name:str):
+		"""
+		Loads the List var_name of every parent with a single query.
+		"""
+		if len(parents) > 0:
+			SQL.For(parents[0].__class__).Prefetch(parents, (var_name,))
+
 	def __len__(self):
 		self.__check_loaded__()	
 		return len(self.items)
@@ -188,16 +232,15 @@ class List(Generic[T]):
 		internal_index = self.items.index(item)
 
 		# Knock the item off the list
-		prev_dict = item.__dict__
-		prev_dict[id_key] = NULL_INT
-		cur_order = prev_dict[order_key]
-		prev_dict[order_key] = NULL_INT
+		cur_order = item.__dict__[order_key]
+		item.__set_column__(id_key, NULL_INT)
+		item.__set_column__(order_key, NULL_INT)
 
 		# Move all items above it down one
 		last_index = len(self.items) - 1
 		for i in range( internal_index, last_index ):
 			move_item = self.items[i+1]
-			move_item[order_key] = cur_order
+			move_item.__set_column__(order_key, cur_order)
 			self.items[i] = move_item
 			cur_order += 1
 		
@@ -215,7 +258,7 @@ class List(Generic[T]):
 
 				# remove it from former items to update
 				if item in self.former_items:
-					self.former_items.pop(item)
+					self.former_items.remove(item)
 
 	def remove(self, item):
 		assert(type(item) == self.child_dc)
@@ -236,17 +279,18 @@ class List(Generic[T]):
 		# Remove any old item that was stored here
 		assert(index < len(self.items))
 		old_item = self.items[index]
-		old_dict = value.__dict__
-		order = old_dict[order_key]
-		self.remove(old_item)
+		order = old_item.__dict__[order_key]
+		old_item.__set_column__(self.id_key, NULL_INT)
+		old_item.__set_column__(order_key, NULL_INT)
+		if old_item not in self.former_items:
+			self.former_items.append(old_item)
 
 		# Set the new value
 		assert(value not in self.items)
-		new_dict = value.__dict__
 		if hasattr(self.parent, "dbid"):
-			new_dict[self.id_key] = self.parent.dbid
+			value.__set_column__(self.id_key, self.parent.dbid)
 		# Set order number -- not necessarily index
-		new_dict[order_key] = order
+		value.__set_column__(order_key, order)
 		self.items[index] = value
 
 	def __contains__(self, value:object) -> bool:
@@ -266,18 +310,17 @@ class List(Generic[T]):
 		order_key = self.order_key
 
 		assert(item not in self.items)
-		new_dict = item.__dict__
 		if hasattr(self.parent, "dbid"):
-			new_dict[self.id_key] = self.parent.dbid
+			item.__set_column__(self.id_key, self.parent.dbid)
 		
 		# Set the order number 
 		if len(self.items) == 0:
-			new_dict[order_key] = 0
+			item.__set_column__(order_key, 0)
 		else:
 			# Set order from last item
 			last_dict = self.items[len(self.items)-1].__dict__
 			last_order = last_dict[order_key]
-			new_dict[order_key] = last_order + 1
+			item.__set_column__(order_key, last_order + 1)
 
 		self.items.append(item)
 
@@ -294,84 +337,100 @@ class List(Generic[T]):
 		order_key = self.order_key
 
 		# clear previous table if needed
-		for i in range( len(self.items) ):
-			item = self.items[i]
-			
+		for item in self.items:
 			# Knock the item off the list
-			prev_dict = item.__dict__
-			prev_dict[id_key] = NULL_INT
-			prev_dict[order_key] = NULL_INT
+			item.__set_column__(id_key, NULL_INT)
+			item.__set_column__(order_key, NULL_INT)
 			if item not in obj_list:
 				self.former_items.append(item)
-			self.items.pop(i)
-		
-		assert(len(self.items) == 0)
+		self.items = []
 		for obj in obj_list:
 			self.append(obj)
 
-	# NOTE: Oddly, updating with sql.UpdateList (executemany) 
-	# is slower than updating with sql.Update (execute).
-
-	def __add_to_db__(self):
+	def __collect_for_db__(self) -> list:
+		"""
+		Links the items to the parent, and returns every item
+		whose row must be written along with the parent.
+		"""
+		to_write = []
 		if not self.from_db:
 			self.__validate_parent__()
+			to_write += self.items
 
-			id_key = self.id_key
-			sql = SQL.Get()
-
-			for item in self.items:
-				item.__dict__[id_key] = self.parent.dbid
-				sql.Update(item, commit=False)
-			#sql.UpdateList(self.items, commit=False)
-			
 			self.from_db = True
 			self.initialized = True
-		else:
-			self.__update_to_db__()
-
-	def __update_to_db__(self):
-		if self.initialized:
+		elif self.initialized:
 			self.__validate_parent__()
 
-			id_key = self.id_key
-			sql = SQL.Get()
-
 			# TODO: handle updates to immutable items stored in list 
 			# (force_update should be true unless it would change other attributes)
 
 			# Update any items that were removed from this list
-			for item in self.former_items:
-				sql.Update(item, commit=False)
-			#sql.UpdateList(self.former_items, commit=False)
+			to_write += self.former_items
 			self.former_items = []
-			
+
 			# Update all items that are now in the list
 			# TODO: could optimize by what's actually been touched
-			for item in self.items:
-				item.__dict__[id_key] = self.parent.dbid
-				sql.Update(item, commit=False)
-			#sql.UpdateList(self.items, commit=False)
+			to_write += self.items
+		else:
+			return to_write
 
-			self.from_db = True
+		id_key = self.id_key
+		parent_dbid = self.parent.dbid
+		for item in self.items:
+			item.__set_column__(id_key, parent_dbid)
+		return to_write
+
+	def __add_to_db__(self):
+		# AddList adds new items and updates stored ones alike
+		SQL.For(self.child_dc).AddList(self.__collect_for_db__(), commit=False)
+
+	__update_to_db__ = __add_to_db__
 	
+	def __state__(self) -> tuple:
+		"""
+		Returns the state of the list, and the list columns of its
+		items, for __restore__ to restore, e.g. after a rollback.
+		"""
+		columns = [
+			(
+				item,
+				item.__dict__.get(self.id_key, NULL_INT),
+				item.__dict__.get(self.order_key, NULL_INT),
+				set(item.__dict__.get("__dirty__", ()))
+			)
+			for item in self.items
+		]
+		return ( self.initialized, self.from_db, list(self.items), list(self.former_items), columns )
+
+	def __restore__(self, state:tuple):
+		self.initialized, self.from_db, items, former_items, columns = state
+		self.items = list(items)
+		self.former_items = list(former_items)
+		for item, list_id, order, dirty in columns:
+			idict = item.__dict__
+			idict[self.id_key] = list_id
+			idict[self.order_key] = order
+			if "__snapshot__" in idict:
+				idict["__dirty__"] = set(dirty)
+
 	def __delete_from_db__(self):
 		self.__check_loaded__()
 		id_key = self.id_key
-		sql = SQL.Get()
+		sql = SQL.For(self.child_dc)
 
-		# Update any items that were removed from this list
-		for item in self.former_items:
-			sql.Update(item, commit=False)
-		#sql.UpdateList(self.former_items, commit=False)
-		self.former_items = []
-		
 		# Unlink all items that are now in the list
 		for item in self.items:
-			item_dict = item.__dict__
-			item_dict[self.id_key] = NULL_INT
-			item_dict[self.order_key] = NULL_INT
-			sql.Update(item, commit=False)
-		#sql.UpdateList(self.items, commit=False)
+			item.__set_column__(self.id_key, NULL_INT)
+			item.__set_column__(self.order_key, NULL_INT)
+
+		# Update them along with any items that were removed from this list.
+		# The DB of the parent commits them, unless they're in another DB
+		sql.AddList(
+			self.former_items + self.items, 
+			commit=sql is not SQL.For(self.parent.__class__)
+		)
+		self.former_items = []
 		self.items = []
 
 		self.from_db = True
\ No newline at end of file
@@ -0,0 +1,428 @@
+import copy
+import heapq
+import random
+import threading
+from contextlib import contextmanager, ExitStack
+from itertools import chain
+
+from .sql import SQL, Query, Pager, Synchronized, NULL_INT
+
+class OrderKey:
+	"""
+	Sort key of a row for the columns of an order by clause. Like
+	sqlite, NULLs come first, and descending columns are reversed.
+	"""
+	__slots__ = ( "values", "descending" )
+
+	def __init__(self, values:tuple, descending:tuple):
+		self.values = values
+		self.descending = descending
+
+	def __lt__(self, other) -> bool:
+		for value, other_value, desc in zip(self.values, other.values, self.descending):
+			if value == other_value:
+				continue
+			if value is None:
+				less = True
+			elif other_value is None:
+				less = False
+			else:
+				less = value < other_value
+			return less != desc
+		return False
+
+
+class ShardedSQL:
+	"""
+	Spreads the tables of classes over several DBs, the shards, by
+	dbid: the row with dbid i is kept by shard i % len(shards).
+
+	crew_db = ShardedSQL([ SQL(f"crew_{i}.db", profile="fast") for i in range(4) ])
+	crew_db.RegisterTables([Crew])
+
+	The classes are bound to it (see SQL.For), so their methods,
+	References and Lists go through it. Reads of a single dbid go to
+	its shard; other queries go to every shard, and their results are
+	merged in the order requested. dbids are assigned here, so a
+	sharded table should only be written by one process.
+
+	Sharded tables have no foreign keys. A transaction is opened on
+	every shard, and the shards commit one after the other.
+
+	Arguments:
+
+	shards	-- The SQLs of the shards, opened with the same settings.
+	"""
+	shards		: list
+	tables		: list
+	lock		: threading.RLock
+	next_dbids	: dict		# table name -> dbid of the next row added
+	pool		: bool
+
+	def __init__(self, shards:list):
+		assert(len(shards) > 0)
+		self.shards = list(shards)
+		self.tables = []
+		self.lock = threading.RLock()
+		self.next_dbids = {}
+		self.pool = all( shard.pool for shard in self.shards )
+
+	def RegisterTables(self, data_classes:list):
+		"""
+		Registers the classes whose tables are sharded, and binds
+		them to this DB. See SQL.RegisterTables.
+		"""
+		SQL.PrepareTables(data_classes)
+		for data_class in data_classes:
+			SQL.Bind(data_class, self)
+		self.OpenTables(data_classes)
+
+	def OpenTables(self, data_classes:list):
+		self.tables = list(data_classes)
+		for shard in self.shards:
+			shard.OpenTables(data_classes)
+
+	def Twin(self):
+		"""
+		Returns a copy of this DB whose shards are twins of its own,
+		that stands for it on the current thread (see SQL.Twin), e.g.
+		a worker thread using shards that aren't pooled.
+		"""
+		twin = copy.copy(self)
+		twin.shards = [ shard.Twin() for shard in self.shards ]
+		twins = getattr(SQL.THREAD, "twins", None)
+		if twins is None:
+			twins = SQL.THREAD.twins = {}
+		twins[self] = twin
+		return twin
+
+	def __shard__(self, dbid:int) -> SQL:
+		return self.shards[dbid % len(self.shards)]
+
+	def __allocate__(self, data_class:type, count:int) -> range:
+		"""
+		Reserves count dbids for new rows of a table. The caller must
+		hold the write lock.
+		"""
+		table_name = data_class.__tablename__
+		next_dbid = self.next_dbids.get(table_name)
+		if next_dbid is None:
+			# AUTOINCREMENT keeps the highest dbid ever used by each shard
+			next_dbid = 1
+			for shard in self.shards:
+				cursor = shard.connection.cursor()
+				cursor.row_factory = None
+				cursor.execute("select max(seq) from sqlite_sequence where name = ?", (table_name,))
+				last = cursor.fetchone()[0]
+				cursor.close()
+				if last is not None:
+					next_dbid = max(next_dbid, last + 1)
+		self.next_dbids[table_name] = next_dbid + count
+		return range(next_dbid, next_dbid + count)
+
+	def __autocommit__(self, commit:bool):
+		for shard in self.shards:
+			shard.__autocommit__(commit)
+
+	@contextmanager
+	def Transaction(self):
+		"""
+		Returns a context manager that groups writes into a single
+		transaction on each shard. See SQL.Transaction.
+		"""
+		with self.lock, ExitStack() as stack:
+			for shard in self.shards:
+				stack.enter_context(shard.Transaction())
+			yield self
+
+	@contextmanager
+	def __labeled__(self, operation:str):
+		with ExitStack() as stack:
+			for shard in self.shards:
+				stack.enter_context(shard.__labeled__(operation))
+			yield
+
+	def AddObserver(self, observer):
+		for shard in self.shards:
+			shard.AddObserver(observer)
+
+	def RemoveObserver(self, observer):
+		for shard in self.shards:
+			shard.RemoveObserver(observer)
+
+	@Synchronized
+	def Commit(self):
+		for shard in self.shards:
+			shard.Commit()
+
+	@Synchronized
+	def Clear(self, data_class:type):
+		for shard in self.shards:
+			shard.Clear(data_class)
+
+	@Synchronized
+	def Add(self, item, commit=True):
+		self.AddList([ item ], commit)
+
+	@Synchronized
+	def AddList(self, i_list:list, commit=True):
+		"""
+		Adds the items in i_list to the shards of their dbids, which
+		are assigned here. Items that are already in the DB are
+		updated instead. See SQL.AddList.
+		"""
+		count = len(self.shards)
+		foreign_groups = {}
+		new_groups = {}
+		update_groups = {}
+		seen = set()
+		for item in i_list:
+			if id(item) in seen:
+				continue
+			seen.add(id(item))
+			data_class = item.__class__
+			dbid = item.__dict__.get("dbid", NULL_INT)
+			if data_class not in self.tables:
+				key, groups = data_class, foreign_groups
+			elif dbid != NULL_INT:
+				key, groups = ( dbid % count, data_class ), update_groups
+			else:
+				key, groups = data_class, new_groups
+			if key not in groups:
+				groups[key] = []
+			groups[key].append(item)
+
+		for data_class, items in foreign_groups.items():
+			SQL.For(data_class).AddList(items)
+
+		for ( index, data_class ), items in update_groups.items():
+			self.shards[index].UpdateList(items, commit=False)
+
+		added = []
+		for data_class, items in new_groups.items():
+			plan = data_class.__sql_plan__
+			skipped = []
+			shard_groups = {}
+			for item, dbid in zip(items, self.__allocate__(data_class, len(items))):
+				index = dbid % count
+				if index not in shard_groups:
+					shard_groups[index] = ( [], [] )
+				shard_groups[index][0].append(item)
+				shard_groups[index][1].append(dbid)
+			for index, ( shard_items, dbids ) in shard_groups.items():
+				shard = self.shards[index]
+				with shard.lock:
+					clock = shard.__clock__()
+					shard_skipped = shard.__insert_rows__(data_class, shard_items, dbids)
+					if clock is not None:
+						rows = len(shard_items) - len(shard_skipped)
+						shard.__observe__(clock, "AddList", data_class, plan.insert_dbid_cmd, rows)
+				skipped += shard_skipped
+			if len(skipped) > 0:
+				# added meanwhile, see SQL.__insert_rows__
+				self.UpdateList(skipped, force_update=True, commit=False)
+				skipped = set(map(id, skipped))
+				items = [ item for item in items if id(item) not in skipped ]
+			added += items
+
+		# finally, add the lists of all new items at once
+		children = []
+		for item in added:
+			for my_list in item.__get_lists__():
+				children += my_list.__collect_for_db__()
+		if len(children) > 0:
+			self.AddList(children, commit=False)
+
+		self.__autocommit__(commit)
+
+	@Synchronized
+	def Update(self, item, force_update=False, commit=True):
+		dbid = item.__dict__.get("dbid", NULL_INT)
+		if dbid == NULL_INT:
+			self.Add(item, commit)
+			return
+		self.__shard__(dbid).Update(item, force_update, commit=False)
+		self.__autocommit__(commit)
+
+	@Synchronized
+	def UpdateList(self, item_list, force_update=False, commit=True):
+		add_list = []
+		groups = {}
+		for item in item_list:
+			dbid = item.__dict__.get("dbid", NULL_INT)
+			if dbid == NULL_INT:
+				add_list.append(item)
+				continue
+			index = dbid % len(self.shards)
+			if index not in groups:
+				groups[index] = []
+			groups[index].append(item)
+
+		self.AddList(add_list, commit=False)
+		for index, items in groups.items():
+			self.shards[index].UpdateList(items, force_update, commit=False)
+		self.__autocommit__(commit)
+
+	@Synchronized
+	def Delete(self, item, force_remove=False, commit=True):
+		dbid = item.__dict__.get("dbid", NULL_INT)
+		if dbid != NULL_INT:
+			self.__shard__(dbid).Delete(item, force_remove, commit=False)
+		self.__autocommit__(commit)
+
+	def BulkImport(self, data_class:type, source) -> range:
+		print(f"WARNING: can't bulk import into sharded {data_class.__name__}, use AddList instead!")
+		return range(0)
+
+	def __merge__(self, data_class:type, results:list, orderby:str, columns=None):
+		"""
+		Merges the results of the shards, each in the order of orderby,
+		into a single iterator in that order.
+		"""
+		order = Query.ParseOrder(orderby)
+		if len(order) == 0:
+			return chain.from_iterable(results)
+		names = [ column for column, desc in order ]
+		descending = tuple( desc for column, desc in order )
+		if columns is not None:
+			columns = tuple(columns)
+			missing = [ name for name in names if name not in columns ]
+			if len(missing) > 0:
+				print(f"WARNING: can't merge shards by {missing[0]}, which isn't selected!")
+				return chain.from_iterable(results)
+			indices = tuple( columns.index(name) for name in names )
+			key = lambda row : OrderKey(tuple( row[i] for i in indices ), descending)
+		else:
+			references = data_class.__sql_plan__.references
+			def key(item):
+				idict = item.__dict__
+				values = []
+				for name in names:
+					value = idict.get(name)
+					if name in references:
+						value = value.ref_id
+					values.append(value)
+				return OrderKey(tuple(values), descending)
+		return heapq.merge(*results, key=key)
+
+	def Select(self, data_class:type, args:tuple, orderby="", prefetch=(),
+		limit=None, offset=None, after_dbid=None, after=None, columns=None, use_cache=True) -> list:
+		"""
+		Selects data from every shard, and returns a list of objects
+		in the order of orderby. See SQL.Select.
+		"""
+		if after_dbid is not None:
+			orderby = SQL.DbidOrder(orderby)
+		order = orderby
+		if after_dbid is not None or after is not None:
+			order = Query.KeysetOrder(orderby)
+		shard_limit = None
+		if limit is not None:
+			# a single shard may hold every row of the result
+			shard_limit = limit + ( offset or 0 )
+		results = [
+			shard.Select(
+				data_class, args, orderby, limit=shard_limit,
+				after_dbid=after_dbid, after=after, columns=columns, use_cache=use_cache
+			)
+			for shard in self.shards
+		]
+		search_list = list(self.__merge__(data_class, results, order, columns))
+		if limit is not None or offset is not None:
+			start = offset or 0
+			end = None if limit is None else start + limit
+			search_list = search_list[start:end]
+
+		if len(prefetch) > 0 and columns is None:
+			self.Prefetch(search_list, prefetch)
+		return search_list
+
+	def Paginate(self, data_class:type, args=None, orderby="", page_size=100, after=None):
+		return Pager(self, data_class, args, orderby, page_size, after)
+
+	def SelectIter(self, data_class:type, args:tuple, orderby="", batch_size=SQL.ITER_BATCH,
+		use_sharedmemory=True, prefetch=(), columns=None):
+		"""
+		Yields the objects selected from every shard one by one, in the
+		order of orderby. Each shard fetches batch_size rows at once.
+		See SQL.SelectIter.
+		"""
+		results = [
+			shard.SelectIter(
+				data_class, args, orderby, batch_size, use_sharedmemory, prefetch, columns
+			)
+			for shard in self.shards
+		]
+		yield from self.__merge__(data_class, results, orderby, columns)
+
+	def SelectAllIter(self, data_class:type, batch_size=SQL.ITER_BATCH,
+		use_sharedmemory=True, prefetch=(), columns=None):
+		yield from self.SelectIter(
+			data_class, None, "", batch_size, use_sharedmemory, prefetch, columns
+		)
+
+	def SelectAll(self, data_class:type, prefetch=(), columns=None) -> list:
+		search_list = []
+		for shard in self.shards:
+			search_list += shard.SelectAll(data_class, columns=columns)
+		if len(prefetch) > 0 and columns is None:
+			self.Prefetch(search_list, prefetch)
+		return search_list
+
+	def SelectOne(self, data_class:type, args:tuple) -> object:
+		for shard in self.shards:
+			item = shard.SelectOne(data_class, args)
+			if item is not None:
+				return item
+		return None
+
+	def SelectAtIndex(self, data_class:type, index:int) -> object:
+		return self.__shard__(index).SelectAtIndex(data_class, index)
+
+	def SelectIn(self, data_class:type, column:str, values, orderby="") -> list:
+		values = list(values)
+		if column != "dbid":
+			groups = { index : values for index in range(len(self.shards)) }
+		else:
+			# only ask each shard for its own dbids
+			groups = {}
+			for dbid in values:
+				index = dbid % len(self.shards)
+				if index not in groups:
+					groups[index] = []
+				groups[index].append(dbid)
+		search_list = []
+		for index, group in groups.items():
+			search_list += self.shards[index].SelectIn(data_class, column, group, orderby)
+		return search_list
+
+	def SelectRandom(self, data_class:type, num=1) -> list:
+		num = max(1, int(num))
+		items = []
+		for shard in self.shards:
+			items += shard.SelectRandom(data_class, num)
+		return random.sample(items, min(num, len(items)))
+
+	def Prefetch(self, items:list, names:tuple):
+		# relations are loaded from the DBs of their classes
+		self.shards[0].Prefetch(items, names)
+
+	def Count(self, data_class:type, args:tuple) -> int:
+		return sum( shard.Count(data_class, args) for shard in self.shards )
+
+	def TableLength(self, data_class:type) -> int:
+		return sum( shard.TableLength(data_class) for shard in self.shards )
+
+	def ToArrays(self, data_class:type, args:tuple, columns=None, orderby="",
+		batch_size=SQL.ITER_BATCH) -> dict:
+		"""
+		Returns the columns of the rows of every shard as NumPy arrays.
+		Rows are in the order of orderby within each shard, and the
+		shards follow one another. See SQL.ToArrays.
+		"""
+		parts = [
+			shard.ToArrays(data_class, args, columns, orderby, batch_size)
+			for shard in self.shards
+		]
+		import numpy as np
+		return { name : np.concatenate([ part[name] for part in parts ]) for name in parts[0].keys() }
@@ -1,85 +1,126 @@
 import sys
 from os import path
-import re
 import sqlite3
+import csv
+import copy
+import threading
+from time import perf_counter
+from contextlib import contextmanager
+from functools import wraps
+from collections import OrderedDict, namedtuple
+from weakref import WeakValueDictionary
 from datetime import datetime, date
-from typing import get_args, get_origin
+from typing import get_args, get_origin, NamedTuple
 
-import pyximport
-pyximport.install()
-from .hash import order_ind_hash
+from .cache import QueryCache, LRUCache
+from .diagnostics import Diagnostics, StatementShape
+from .metrics import StatementEvent
 
 NULL_INT = 0
 
+def Synchronized(method):
+	"""
+	Makes a method of SQL hold its write lock while it runs, so
+	that writes from several threads don't interleave.
+	"""
+	@wraps(method)
+	def locked(self, *args, **kwargs):
+		with self.lock:
+			return method(self, *args, **kwargs)
+	return locked
+
 class SQLBaseType:
 	pass
 
+class Expr(tuple):
+	"""
+	A query expression, i.e. a tuple of ( sql string, arguments ), 
+	that also carries a canonical key describing the query. Two
+	expressions have equal keys only if they're the same query, up 
+	to the order of the operands of And and Or.
+	"""
+	def __new__(cls, sql_str:str, args:tuple, key:tuple):
+		expr = super().__new__(cls, ( sql_str, args ))
+		expr.key = key
+		return expr
+
+
 class Query:
 	def PreprocessValue(val):
 		value = val
 		if issubclass(type(val), SQLBaseType):
 			value = val.dbid
-		elif get_origin(val) == "Reference":
+		elif type(val).__name__ == "Reference":
 			value = val.ref_id
 		return value
 
-	def Equals(var_name, val):
-		return (
-			f"{var_name} = ?", 
-			( Query.PreprocessValue(val), )
+	def TypedValue(val) -> tuple:
+		"""
+		Returns a hashable ( type, value ) pair for a query argument,
+		so that e.g. 1, 1.0 and True produce different keys.
+		"""
+		t = type(val)
+		if t.__name__ in SQL.TYPE_ADAPTERS:
+			val = SQL.TYPE_ADAPTERS[t.__name__](val)
+		elif hasattr(val, "__sql_adapter__"):
+			val = val.__sql_adapter__()
+		return ( t, val )
+
+	def KeyOf(expr) -> tuple:
+		"""
+		Returns the canonical key of an expression. Plain tuples
+		of ( sql string, arguments ) are keyed by their text.
+		"""
+		if type(expr) == Expr:
+			return expr.key
+		return ( "sql", expr[0], tuple( Query.TypedValue(v) for v in expr[1] ) )
+
+	def Compare(op:str, var_name, val):
+		return Expr(
+			f"{var_name} {op} ?",
+			( val, ),
+			( op, var_name, Query.TypedValue(val) )
 		)
 
+	def Equals(var_name, val):
+		return Query.Compare("=", var_name, Query.PreprocessValue(val))
+
 	def NotEquals(var_name, val):
-		return (
-			f"{var_name} != ?", 
-			( Query.PreprocessValue(val), )
-		)
+		return Query.Compare("!=", var_name, Query.PreprocessValue(val))
 
 	def LessThan(var_name, val):
-		return (
-			f"{var_name} < ?", 
-			( val, )
-		)
+		return Query.Compare("<", var_name, val)
 
 	def LessThanEquals(var_name, val):
-		return (
-			f"{var_name} <= ?", 
-			( val, )
-		)
+		return Query.Compare("<=", var_name, val)
 	
 	def GreaterThan(var_name, val):
-		return (
-			f"{var_name} > ?",
-			( val, )
-		)
+		return Query.Compare(">", var_name, val)
 	
 	def GreaterThanEquals(var_name, val):
-		return (
-			f"{var_name} >= ?",
-			( val, )
-		)
+		return Query.Compare(">=", var_name, val)
 	
 	def Between(var_name, val1, val2):
-		return (
+		return Expr(
 			f"{var_name} between ? and ?",
-			( val1, val2, )
+			( val1, val2, ),
+			( "between", var_name, Query.TypedValue(val1), Query.TypedValue(val2) )
 		)
 
 	def Like(var_name, pattern):
-		return (
-			f"{var_name} like ?",
-			( pattern, )
-		)
+		return Query.Compare("like", var_name, pattern)
 
 	def Not(expr):
-		return (
+		return Expr(
 			f"not ({expr[0]})",
-			expr[1]
+			expr[1],
+			( "not", Query.KeyOf(expr) )
 		)
 
-	def ChainExprs(exprs, chain_str=", "):
+	def ChainExprs(exprs, chain_str=", ", commutative=False):
 		query_str = []
 		val_tup = ()
+		keys = []
 		expr_range = len(exprs) - 1
 		for i in range(expr_range):
 			expr = exprs[i]
@@ -88,36 +129,513 @@ class Query:
 		expr = exprs[expr_range]
 		query_str.append(f"({expr[0]})")
 		val_tup += expr[1]
-		return ( 
+
+		for expr in exprs:
+			key = Query.KeyOf(expr)
+			if commutative and key[0] == chain_str:
+				# flatten nested chains of the same operator
+				keys += key[1]
+			else:
+				keys.append(key)
+		if commutative:
+			keys = frozenset(keys)
+		else:
+			keys = tuple(keys)
+		return Expr(
 			"".join(query_str), 
-			val_tup 
+			val_tup,
+			( chain_str, keys )
 		)
 
 	def And(*exprs):
-		return Query.ChainExprs(exprs, chain_str=" and ")
+		return Query.ChainExprs(exprs, chain_str=" and ", commutative=True)
 	
 	def Or(*exprs):
-		return Query.ChainExprs(exprs, chain_str=" or ")
+		return Query.ChainExprs(exprs, chain_str=" or ", commutative=True)
 
 	OrderAscending 	= lambda v : f"{v} asc"
 
 	OrderDescending = lambda v : f"{v} desc"
 
 	def OrderChain(*exprs):
-		return Query.ChainExprs(exprs)
+		return ", ".join(exprs)
+
+	def ParseOrder(orderby:str) -> list:
+		"""
+		Splits an order by clause into a list of ( column, descending ).
+		"""
+		order = []
+		for term in orderby.split(","):
+			words = term.split()
+			if len(words) > 0:
+				order.append( ( words[0], len(words) > 1 and words[1].lower() == "desc" ) )
+		return order
+
+	def KeysetOrder(orderby:str) -> str:
+		"""
+		Returns orderby with the dbid appended as a tie-breaker, so 
+		that rows are in a total order for keyset pagination.
+		"""
+		order = Query.ParseOrder(orderby)
+		if "dbid" in [ column for column, desc in order ]:
+			return orderby
+		if orderby == "":
+			return Query.OrderAscending("dbid")
+		return Query.OrderChain(orderby, Query.OrderAscending("dbid"))
+
+	def After(orderby:str, values:tuple):
+		"""
+		Matches the rows that come after the row with the given values
+		of the columns of orderby (see KeysetOrder), i.e. for columns 
+		c1, c2, c3:
+
+		(c1 > v1) or (c1 = v1 and c2 > v2) or (c1 = v1 and c2 = v2 and c3 > v3)
+
+		with < instead of > for descending columns.
+		"""
+		order = Query.ParseOrder(Query.KeysetOrder(orderby))
+		assert(len(order) == len(values))
+		exprs = []
+		for i in range(len(order)):
+			column, desc = order[i]
+			op = "<" if desc else ">"
+			terms = [ Query.Equals(order[j][0], values[j]) for j in range(i) ]
+			terms.append( Query.Compare(op, column, values[i]) )
+			exprs.append( Query.And(*terms) )
+		return Query.Or(*exprs)
+
+
+class Index(NamedTuple):
+	"""
+	Declares a secondary index in the __indexes__ of a class:
+
+	class Vessel(Mutable):
+		...
+		__indexes__ = [
+			"name",							# single column
+			( "nation", "year" ),			# composite
+			Index( ("name",), unique=True ),
+			Index( ("speed",), where="speed > 0" )	# partial
+		]
+
+	Arguments:
+
+	columns	-- Names of the indexed columns, in order.
+	unique	-- Whether the values of the columns must be unique.
+	where	-- Optional condition, in SQL, restricting the indexed rows.
+	name	-- Name of the index (by default, made from the table and
+			   column names).
+	"""
+	columns	: tuple
+	unique	: bool = False
+	where	: str = ""
+	name	: str = ""
+
+
+class TablePlan(NamedTuple):
+	"""
+	Precompiled statements and column layout for a data class.
+	Built once by RegisterTables, and used by every write and
+	point read on the class.
+	"""
+	table_name	: str
+	columns		: tuple		# column names, in table order (excluding dbid)
+	column_index: dict		# column name -> position in columns
+	defaults	: tuple		# default value for each column
+	adapters	: tuple		# ( index, column name, adapter ) for adapted columns
+	custom		: tuple		# ( index, column name, adapter ) for custom types
+	layout		: tuple		# ( name, default, adapter, position in custom ) of each column
+	references	: frozenset	# names of Reference columns
+	insert_cmd	: str
+	insert_dbid_cmd : str	# insert with an explicit dbid
+	update_cmd	: str
+	delete_cmd	: str
+	select_cmd	: str
+	update_cmds	: dict		# partial update statements, by column indices
+	row_types	: dict		# namedtuple types of projections, by columns
+
+	def RowValues(self, idict:dict, adapted=None) -> list:
+		"""
+		Extracts the column values of an item, in column order,
+		from its __dict__. If the adapted values of its custom types
+		are given (see Adapted), they're used instead of the objects.
+		"""
+		values = [
+			idict.get(name, default) for name, default in zip(self.columns, self.defaults)
+		]
+		for index, name, adapter in self.adapters:
+			if name in idict:
+				values[index] = adapter(idict[name])
+		if adapted is not None:
+			for ( index, name, adapter ), value in zip(self.custom, adapted):
+				if name in idict:
+					values[index] = value
+		return values
+
+	def ColumnValues(self, idict:dict, indices:tuple, adapted:tuple) -> list:
+		"""
+		Like RowValues, but only for the columns at indices.
+		"""
+		values = []
+		for index in indices:
+			name, default, adapter, position = self.layout[index]
+			if name not in idict:
+				values.append(default)
+			elif position is not None:
+				values.append(adapted[position])
+			elif adapter is not None:
+				values.append(adapter(idict[name]))
+			else:
+				values.append(idict[name])
+		return values
+
+	def Adapted(self, idict:dict) -> tuple:
+		"""
+		Returns the adapted values of the custom types of an item.
+		"""
+		return tuple(
+			adapter(idict[name]) if name in idict else None
+			for index, name, adapter in self.custom
+		)
+
+	def Snapshot(self, idict:dict, adapted=None):
+		"""
+		Marks an item as clean, i.e. identical to its row in the DB.
+
+		Custom types can be modified in place without going through
+		__setattr__, so we remember their adapted values to compare 
+		against later. Pass them if they've just been computed.
+		"""
+		if adapted is None:
+			adapted = self.Adapted(idict)
+		idict["__snapshot__"] = adapted
+		idict["__dirty__"] = set()
+
+	def DirtyColumns(self, idict:dict) -> tuple:
+		"""
+		Returns the sorted indices of the columns of an item that
+		changed since it was last read or written, or None if the 
+		item isn't tracked and its whole row must be written, along
+		with the adapted values of its custom types.
+		"""
+		adapted = self.Adapted(idict)
+		snapshot = idict.get("__snapshot__")
+		if snapshot is None:
+			return ( None, adapted )
+		column_index = self.column_index
+		dirty = set(
+			column_index[name] for name in idict["__dirty__"] if name in column_index
+		)
+		for ( index, name, adapter ), value, previous in zip(self.custom, adapted, snapshot):
+			if name in idict and value != previous:
+				dirty.add(index)
+		return ( tuple(sorted(dirty)), adapted )
+
+	def RowType(self, columns:tuple):
+		"""
+		Returns the namedtuple type of rows projected onto columns, or
+		None if one of them isn't a column of the table. Columns whose
+		names aren't valid field names (e.g. those starting with an
+		underscore) are renamed to their position, e.g. _1.
+		"""
+		row_type = self.row_types.get(columns)
+		if row_type is None:
+			for name in columns:
+				if name != "dbid" and name not in self.column_index:
+					print(f"WARNING: {name} is not a column of {self.table_name}!")
+					return None
+			row_type = namedtuple("Row", columns, rename=True)
+			self.row_types[columns] = row_type
+		return row_type
+
+	def UpdateCommand(self, indices:tuple) -> str:
+		"""
+		Returns the update statement for a subset of columns.
+		"""
+		if len(indices) == len(self.columns):
+			return self.update_cmd
+		cmd = self.update_cmds.get(indices)
+		if cmd is None:
+			set_str = ", ".join( f"{self.columns[i]} = ?" for i in indices )
+			cmd = f"update {self.table_name} set {set_str} where dbid = ?"
+			self.update_cmds[indices] = cmd
+		return cmd
+
+
+class Transaction:
+	"""
+	Context manager returned by SQL.Transaction. 
+
+	Writes made inside the block are not committed individually; 
+	the outermost block commits once on exit. Blocks can be nested,
+	each level being a SAVEPOINT that is rolled back on its own if
+	an exception escapes it.
+	"""
+	sql		: object
+	name	: str
+
+	def __init__(self, sql):
+		self.sql = sql
+		self.name = ""
+
+	def __enter__(self):
+		sql = self.sql
+		# other threads can't write until the outermost block exits
+		sql.lock.acquire()
+		# our reads must see our own writes
+		with sql.memory_lock:
+			sql.writers[threading.get_ident()] = sql.connection
+		self.name = f"narwhal_{len(sql.transactions)}"
+		sql.connection.execute(f"savepoint {self.name}")
+		# journal of the writes made at this level
+		sql.transactions.append([])
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		sql = self.sql
+		try:
+			journal = sql.transactions.pop()
+			if exc_type is None:
+				sql.connection.execute(f"release {self.name}")
+				if len(sql.transactions) > 0:
+					# hand our writes over to the enclosing level
+					sql.transactions[-1] += journal
+				else:
+					sql.connection.commit()
+			else:
+				sql.connection.execute(f"rollback to {self.name}")
+				sql.connection.execute(f"release {self.name}")
+				sql.__rollback_journal__(journal)
+		finally:
+			if len(sql.transactions) == 0:
+				sql.__committed__()
+			sql.lock.release()
+		return False
+
+
+class BulkLoad:
+	"""
+	Context manager returned by SQL.BulkLoad.
+
+	For the duration of the block, the secondary indexes of the 
+	loaded tables are dropped, foreign keys aren't enforced, the
+	journal is kept in memory without syncing to disk, and the cache
+	and shared memory are bypassed. All writes go into a single 
+	transaction. 
+	
+	On exit the indexes are rebuilt, foreign keys are checked (with
+	a warning for every violation), and the tables are analyzed, 
+	before the transaction is committed. If any of it fails, e.g. 
+	because the rows violate a unique index, the whole load is rolled
+	back. Either way, the previous settings are restored.
+	"""
+	sql			: object
+	tables		: list
+	indexes		: list		# ( name, sql ) of the dropped indexes
+	settings	: dict		# PRAGMA name -> value before the load
+	transaction	: Transaction
+
+	PRAGMAS = (
+		( "foreign_keys", "off" ),
+		( "synchronous", "off" ),
+		( "journal_mode", "memory" )
+	)
+
+	def __init__(self, sql, tables:list):
+		self.sql = sql
+		self.tables = tables
+		self.indexes = []
+		self.settings = {}
+		self.transaction = None
+
+	def __enter__(self):
+		sql = self.sql
+		if len(sql.transactions) > 0:
+			# these PRAGMAs are no-ops inside a transaction
+			print("WARNING: BulkLoad inside a transaction keeps foreign keys and journaling on!")
+		else:
+			sql.connection.commit()
+			sql.__committed__()
+			for name, value in BulkLoad.PRAGMAS:
+				self.settings[name] = sql.Pragma(name)
+				sql.Pragma(name, value)
+
+		self.use_cache = sql.use_cache
+		self.use_sharedmemory = sql.use_sharedmemory
+		sql.use_cache = False
+		sql.use_sharedmemory = False
+
+		# indexes are dropped inside the transaction, so that they're
+		# back if it's rolled back
+		self.transaction = sql.Transaction()
+		self.transaction.__enter__()
+		try:
+			cursor = sql.connection.cursor()
+			cursor.row_factory = None
+			for data_class in self.tables:
+				# indexes sqlite makes for constraints have no sql, and can't be dropped
+				cursor.execute(
+					"select name, sql from sqlite_master where type = 'index' "
+					"and tbl_name = ? and sql is not null",
+					( data_class.__tablename__, )
+				)
+				self.indexes += cursor.fetchall()
+			for name, index_sql in self.indexes:
+				cursor.execute(f"drop index {name}")
+			cursor.close()
+		except BaseException as e:
+			self.__exit__(type(e), e, e.__traceback__)
+			raise
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		sql = self.sql
+		try:
+			if exc_type is None:
+				# still inside the transaction, so that if an index can't
+				# be rebuilt (e.g. a unique one), the load is rolled back
+				try:
+					self.Finish()
+				except BaseException as e:
+					self.transaction.__exit__(type(e), e, e.__traceback__)
+					raise
+			self.transaction.__exit__(exc_type, exc_value, traceback)
+		finally:
+			sql.use_cache = self.use_cache
+			sql.use_sharedmemory = self.use_sharedmemory
+			# shared memory missed the changes, so forget what it held
+			loaded = set(self.tables)
+			for data_class in loaded:
+				if data_class.__name__ in sql.sharedmemory:
+					sql.sharedmemory[data_class.__name__].clear()
+			for key in [ key for key in sql.pinned.keys() if key[0] in loaded ]:
+				del sql.pinned[key]
+			# deletes may have set references in other tables to null
+			for data_class in sql.tables:
+				sql.cache.Invalidate(data_class.__tablename__)
+
+			for name, value in self.settings.items():
+				sql.Pragma(name, value)
+		return False
+
+	def Finish(self):
+		"""
+		Rebuilds the dropped indexes, checks foreign keys, and analyzes
+		the loaded tables.
+		"""
+		cursor = self.sql.connection.cursor()
+		cursor.row_factory = None
+		try:
+			for name, index_sql in self.indexes:
+				cursor.execute(index_sql)
+			for data_class in self.tables:
+				cursor.execute(f"PRAGMA foreign_key_check({data_class.__tablename__})")
+				for table, rowid, parent, fkid in cursor.fetchall():
+					print(f"WARNING: row {rowid} of {table} references a missing row of {parent}!")
+			for data_class in self.tables:
+				cursor.execute(f"analyze {data_class.__tablename__}")
+		finally:
+			cursor.close()
+
+
+class Pager:
+	"""
+	Iterates over the results of a query one page at a time, using
+	keyset pagination: each page is selected as the rows that come 
+	after the last row of the previous page, so pages deep into the
+	results cost as little as the first one.
+
+	The position is kept in after, which can be saved and passed to
+	SQL.Paginate later to resume.
+	"""
+	sql			: object
+	data_class	: type
+	args		: tuple
+	orderby		: str
+	page_size	: int
+	after		: tuple
+	done		: bool
+
+	def __init__(self, sql, data_class:type, args, orderby:str, page_size:int, after=None):
+		self.sql = sql
+		self.data_class = data_class
+		self.args = args
+		self.orderby = Query.KeysetOrder(orderby)
+		self.page_size = page_size
+		self.after = after
+		self.done = False
+
+	def NextPage(self) -> list:
+		"""
+		Returns the next page of results, or an empty list at the end.
+		"""
+		if self.done:
+			return []
+		page = self.sql.Select(
+			self.data_class,
+			self.args,
+			self.orderby,
+			limit=self.page_size,
+			after=self.after,
+			# each page is only read once
+			use_cache=False
+		)
+		if len(page) < self.page_size:
+			self.done = True
+		if len(page) > 0:
+			last = page[-1].__dict__
+			references = self.data_class.__sql_plan__.references
+			after = []
+			for column, desc in Query.ParseOrder(self.orderby):
+				if column in references:
+					after.append(last[column].ref_id)
+				else:
+					after.append(last[column])
+			self.after = tuple(after)
+		return page
+
+	def __iter__(self):
+		while True:
+			page = self.NextPage()
+			if len(page) == 0:
+				return
+			yield page
 
 
 class SQL:
 	DEFAULT_DB = None
+	# every class registered, whatever its DB
 	TABLES = []
 
-	HASH_RE = re.compile("\?")
+	# state of each thread, see Local
+	THREAD = threading.local()
+
+	# number of rows sent to the DB per executemany call
+	BULK_CHUNK = 4096
+	# number of values sent to the DB per "in (...)" clause
+	IN_CHUNK = 500
+	# number of rows fetched at once when streaming results
+	ITER_BATCH = 1000
 
 	use_cache: bool
-	cache: dict
+	cache: QueryCache
 	use_sharedmemory: bool
 	sharedmemory: dict
+	pinned: OrderedDict
+	pin_size: int
+	read_only: bool
+	pool: bool
+	lock: threading.RLock
+	memory_lock: threading.RLock
+	readers: threading.local
+	writers: dict
+	pending: dict
+	twinned: bool
 	will_init_tables: bool
+	transactions: list
+	diagnostics: Diagnostics
+	observers: list
+	labels: threading.local
 
 	TYPE_TABLE = {
 		"str" 				: "text",
@@ -138,15 +656,64 @@ class SQL:
 
 	TYPE_ADAPTERS = {}
 
-	def RegisterTypeConversion(data_class:type, adapter, converter, default):
+	# connection settings, see __init__. cached_statements is the
+	# size of the statement cache of the connection, the rest are
+	# PRAGMAs.
+	PROFILES = {
+		# commits survive power loss, and readers don't block the writer
+		"durable" : {
+			"journal_mode"		: "wal",
+			"synchronous"		: "full",
+			"cache_size"		: -64 * 1024,			# KiB
+			"temp_store"		: "memory",
+			"cached_statements"	: 256
+		},
+		# commits may be lost on power loss, but the DB stays consistent
+		"fast" : {
+			"journal_mode"		: "wal",
+			"synchronous"		: "normal",
+			"cache_size"		: -256 * 1024,
+			"mmap_size"			: 1024 * 1024 * 1024,
+			"temp_store"		: "memory",
+			"cached_statements"	: 512
+		},
+		# opened read-only, e.g. for analytics on a DB written elsewhere
+		"read_only" : {
+			"cache_size"		: -256 * 1024,
+			"mmap_size"			: 1024 * 1024 * 1024,
+			"temp_store"		: "memory",
+			"cached_statements"	: 512
+		}
+	}
+
+	# sql type -> ( array adapter, array fields ), see RegisterTypeConversion
+	TYPE_ARRAYS = {}
+
+	# NumPy dtypes of the builtin sql types in ToArrays
+	ARRAY_DTYPES = {
+		"integer"	: "int64",
+		"real"		: "float64",
+		"text"		: "object",
+		"date"		: "datetime64[D]",
+		"timestamp"	: "datetime64[us]"
+	}
+
+	def RegisterTypeConversion(data_class:type, adapter, converter, default, 
+		array_adapter=None, array_fields=None):
 		"""
 		Register your custom data type for storage in the DB.
 
 		Arguments:
-		data_class	--	The type of the data
-		adapter		--	The function used to convert the data into a sqlite value.
-		converter	--  The function used to convert a sqlite value into the data.
-		default		--  The default value
+		data_class		--	The type of the data
+		adapter			--	The function used to convert the data into a sqlite value.
+		converter		--  The function used to convert a sqlite value into the data.
+		default			--  The default value
+		array_adapter	--	Optional function converting the data into a sequence
+							of floats, so that it can be exported by ToArrays.
+		array_fields	--	Optional names of the values returned by array_adapter.
+							If given, each value is exported as its own array
+							(e.g. position_lat, position_lng), otherwise they're
+							exported together as a 2-D array.
 		"""
 		type_name = data_class.__name__
 		sql_type = type_name.lower()
@@ -155,6 +722,8 @@ class SQL:
 		sqlite3.register_adapter(data_class, adapter)
 		SQL.TYPE_ADAPTERS[type_name] = adapter
 		sqlite3.register_converter(sql_type, converter)
+		if array_adapter is not None:
+			SQL.TYPE_ARRAYS[sql_type] = ( array_adapter, array_fields )
 
 	def ListIdentifier(parent_dc:type, varname:str):
 		"""
@@ -187,11 +756,21 @@ class SQL:
 
 		list_id_column = ( id, "integer" )
 		list_order_column = ( order, "integer" )
+		if "__sql_plan__" in child_class.__dict__ and list_id_column not in sql_columns:
+			print(f"WARNING: prepare {parent_class.__name__} along with {child_class.__name__}, which holds its {varname}!")
 		if list_id_column not in sql_columns:
 			sql_columns.append(list_id_column)
 		if list_order_column not in sql_columns:
 			sql_columns.append(list_order_column)
 
+		# index the list columns, so that loading a list doesn't
+		# scan the whole child table
+		if not hasattr(child_class, "__list_indexes__"):
+			child_class.__list_indexes__ = []
+		list_index = Index( ( id, order ) )
+		if list_index not in child_class.__list_indexes__:
+			child_class.__list_indexes__.append(list_index)
+
 		parent_class.__list_defs__.append((varname, child_class.__name__))
 
 		# TODO: add to foreign keys of child
@@ -210,62 +789,317 @@ class SQL:
 		"""
 
 	def Get():
-		return SQL.DEFAULT_DB
+		return SQL.Local(SQL.DEFAULT_DB)
+
+	def For(data_class:type):
+		"""
+		Returns the DB that holds the table of a class: the one it
+		was registered with or bound to, or else the default DB.
+		"""
+		return SQL.Local(data_class.__dict__.get("__sql_db__", SQL.DEFAULT_DB))
+
+	def Local(sql):
+		"""
+		Returns the DB that stands for sql on the current thread: its
+		twin, if one was made on this thread (see Twin), or else sql.
+		"""
+		twins = getattr(SQL.THREAD, "twins", None)
+		if twins is None:
+			return sql
+		return twins.get(sql, sql)
+
+	def Bind(data_class:type, sql):
+		"""
+		Makes sql the DB that holds the table of a class, e.g. an
+		SQL, or a ShardedSQL spreading it over several files.
+		"""
+		data_class.__sql_db__ = sql
+
+	def __init__(self, db_path:str, use_cache=False, use_sharedmemory=False, cache=None, pin_size=0,
+		diagnostics=False, profile=None, pragmas=None, read_only=False, pool=False):
+		"""
+		Opens the DB at db_path, and makes it the default DB.
 
-	def __init__(self, db_path:str, use_cache=False, use_sharedmemory=False):
+		Arguments:
+
+		use_cache			-- cache the results of queries
+		use_sharedmemory	-- keep a single copy of each row in memory
+		cache				-- QueryCache to use, e.g. LRUCache(max_bytes=...).
+							   Implies use_cache.
+		pin_size			-- number of recently loaded objects that shared
+							   memory keeps alive even if nothing else
+							   references them
+		diagnostics			-- explain and time every statement shape, 
+							   see EnableDiagnostics
+		profile				-- name of the connection settings in 
+							   SQL.PROFILES to use: "durable", "fast" or
+							   "read_only" (default: those of sqlite)
+		pragmas				-- dict of PRAGMA name -> value, applied after
+							   those of the profile
+		read_only			-- open the DB read-only; tables aren't created.
+							   Implied by the "read_only" profile.
+		pool				-- let several threads use the DB at once. Each
+							   thread reads through its own read-only
+							   connection, and writes go through a single
+							   shared connection, one thread at a time. 
+							   The DB is put in WAL mode.
+		"""
+		settings = {}
+		if profile is not None:
+			if profile not in SQL.PROFILES:
+				print(f"WARNING: {profile} is not a connection profile!")
+			else:
+				settings.update(SQL.PROFILES[profile])
+		if pragmas is not None:
+			settings.update(pragmas)
+		self.db_path = db_path
+		self.cached_statements = settings.pop("cached_statements", 128)
+		self.settings = settings
+
+		self.read_only = read_only or profile == "read_only"
 		self.will_init_tables = False
-		if db_path == ":memory:" or not path.exists(db_path):
+		if not self.read_only and ( db_path == ":memory:" or not path.exists(db_path) ):
 			self.will_init_tables = True
+
+		self.pool = pool
+		if pool and db_path == ":memory:":
+			print("WARNING: an in-memory DB can't be pooled, so it's only usable from one thread!")
+			self.pool = False
+		self.lock = threading.RLock()
+		self.memory_lock = threading.RLock()
+		self.readers = threading.local()
+		# thread -> the connection holding its uncommitted writes, and
+		# connection -> the tables it has uncommitted writes to
+		self.writers = {}
+		self.pending = {}
+		# whether a twin shares the cache, see Twin
+		self.twinned = False
 		
-		self.connection = sqlite3.connect(
-			db_path,
-			detect_types=sqlite3.PARSE_DECLTYPES
-		)
-		self.connection.row_factory = sqlite3.Row
-		self.use_cache = use_cache
-		self.cache = {}
-		self.use_sharedmemory = use_sharedmemory or use_cache
+		self.connection = self.__connect__(self.read_only, check_same_thread=not self.pool)
+		self.use_cache = use_cache or cache is not None
+		self.cache = cache if cache is not None else LRUCache()
+		self.use_sharedmemory = use_sharedmemory or self.use_cache
 		self.sharedmemory = {}
+		self.pinned = OrderedDict()
+		self.pin_size = pin_size
+		self.transactions = []
+		self.tables = []
+		self.diagnostics = None
+		self.observers = []
+		self.labels = threading.local()
+		if diagnostics:
+			self.EnableDiagnostics()
 		SQL.DEFAULT_DB = self
 
+		if self.pool and not self.read_only:
+			# so that readers don't block the writer, nor the other way around
+			self.Pragma("journal_mode", "wal")
+
+	def __connect__(self, read_only:bool, check_same_thread=True):
+		"""
+		Opens a connection to the DB, with the settings of the profile.
+		"""
+		if read_only and self.db_path != ":memory:":
+			# fails if the DB doesn't exist, instead of creating it
+			connection = sqlite3.connect(
+				f"file:{path.abspath(self.db_path)}?mode=ro",
+				uri=True,
+				detect_types=sqlite3.PARSE_DECLTYPES,
+				cached_statements=self.cached_statements,
+				check_same_thread=check_same_thread
+			)
+		else:
+			connection = sqlite3.connect(
+				self.db_path,
+				detect_types=sqlite3.PARSE_DECLTYPES,
+				cached_statements=self.cached_statements,
+				check_same_thread=check_same_thread
+			)
+		connection.row_factory = sqlite3.Row
+
 		# activate foreign keys
-		self.connection.execute("PRAGMA foreign_keys = ON")
+		connection.execute("PRAGMA foreign_keys = ON")
+		for name, value in self.settings.items():
+			if read_only and name in ( "journal_mode", "synchronous" ):
+				# only matter to writers
+				continue
+			connection.execute(f"PRAGMA {name} = {value}")
+		if read_only:
+			connection.execute("PRAGMA query_only = 1")
+		return connection
+
+	def __reader__(self):
+		"""
+		Returns the connection to read from. In pool mode, that's the
+		read-only connection of the current thread, unless the thread
+		has uncommitted writes, which only the writer connection can see.
+		"""
+		if not self.pool or threading.get_ident() in self.writers:
+			return self.connection
+		connection = getattr(self.readers, "connection", None)
+		if connection is None:
+			# closed when the thread exits
+			connection = self.__connect__(True)
+			self.readers.connection = connection
+		return connection
+
+	def Twin(self):
+		"""
+		Returns a copy of this DB with a connection of its own, that
+		stands for it on the current thread (see Local), e.g. a worker
+		thread using a DB that isn't pooled. The twin shares the 
+		tables, cache, shared memory, write lock, pending writes and
+		diagnostics of the DB, so both return the same objects.
+		"""
+		self.twinned = True
+		twin = copy.copy(self)
+		twin.connection = self.__connect__(self.read_only)
+		twin.readers = threading.local()
+		twin.transactions = []
+		twins = getattr(SQL.THREAD, "twins", None)
+		if twins is None:
+			twins = SQL.THREAD.twins = {}
+		twins[self] = twin
+		return twin
+
+	def Pragma(self, name:str, value=None):
+		"""
+		Returns the value of a PRAGMA, after setting it if a value is
+		given, e.g. sql.Pragma("journal_mode", "wal").
+		"""
+		if value is not None:
+			cmd = f"PRAGMA {name} = {value}"
+		else:
+			cmd = f"PRAGMA {name}"
+		result = self.connection.execute(cmd).fetchone()
+		if result is None:
+			return None
+		return result[0]
+
+	def EnableDiagnostics(self, large_table=1000):
+		"""
+		Starts recording the query plan, number of calls and total 
+		time of every distinct statement shape, and flagging those
+		which scan tables of at least large_table rows. See 
+		QueryReport.
+		"""
+		self.diagnostics = Diagnostics(self.connection, large_table)
 
-	def CommandHash(cmd:str, args:tuple) -> int:
+	def DisableDiagnostics(self):
+		self.diagnostics = None
+
+	def QueryReport(self) -> str:
+		"""
+		Returns a report of the statements run since diagnostics 
+		were enabled, the most time-consuming first.
+		"""
+		if self.diagnostics is None:
+			print("WARNING: diagnostics aren't enabled!")
+			return ""
+		return self.diagnostics.Report()
+
+	def AddObserver(self, observer):
 		"""
-		Calculates a integer hash for the SQL command after 
-		substituting arguments into '?'. The hash is order-
-		independent, meaning that any collection of identical
-		characters will return the same hash, regardless of the
-		order in which they're arranged.
+		Registers a callable that is passed a StatementEvent after
+		every operation on the DB, e.g. a metrics.MetricsAggregator.
 		"""
-		arg_list = list(args)
+		self.observers.append(observer)
 
-		def next_arg(m):
-			arg = arg_list.pop(0)
-			arg_typename = type(arg).__name__
-			if arg_typename in SQL.TYPE_ADAPTERS:
-				arg = SQL.TYPE_ADAPTERS[arg_typename](arg)
-			elif hasattr(arg, "__sql_adapter__"):
-				arg = arg.__sql_adapter__()
-			if type(arg) == str:
-				return f"\"{arg}\""
-			return str(arg)
+	def RemoveObserver(self, observer):
+		self.observers.remove(observer)
 
-		# substitute arguments into list
-		cmd_str = SQL.HASH_RE.sub(next_arg, cmd)
-		return order_ind_hash(cmd_str)
+	def __clock__(self):
+		"""
+		Returns the start time of an operation, or None if nobody
+		is observing it.
+		"""
+		if len(self.observers) == 0:
+			return None
+		return perf_counter()
+
+	def __observe__(self, start:float, operation:str, data_class:type, cmd:str, 
+		rows:int, objects=0, cache_hit=None):
+		"""
+		Reports an operation that started at start to the observers.
+		Operations run on behalf of another one (see __labeled__) are 
+		reported under its name instead.
+		"""
+		label = getattr(self.labels, "operation", None)
+		if label is not None:
+			operation = label
+		event = StatementEvent(
+			operation	= operation,
+			table		= data_class.__tablename__,
+			shape		= StatementShape(cmd),
+			elapsed		= perf_counter() - start,
+			rows		= rows,
+			objects		= objects,
+			cache_hit	= cache_hit
+		)
+		for observer in self.observers:
+			observer(event)
+
+	@contextmanager
+	def __labeled__(self, operation:str):
+		"""
+		Reports the operations run inside the block as operation,
+		e.g. "List" for the query loading a List. Labels only apply
+		to the current thread.
+		"""
+		labels = self.labels
+		previous = getattr(labels, "operation", None)
+		if previous is None:
+			labels.operation = operation
+		try:
+			yield
+		finally:
+			labels.operation = previous
+
+	def __run__(self, cmd:str, args=(), cursor=None, many=False, fetch=None):
+		"""
+		Runs a statement. Every statement on table data goes through 
+		here, so that it can be explained and timed.
+
+		Arguments:
+
+		cursor	-- Cursor to run it on (by default, a new one).
+		many	-- If True, args is a sequence of arguments, run with
+				   executemany.
+		fetch	-- "one" or "all" to fetch the results and close the
+				   cursor, otherwise the cursor is returned. Only the time
+				   spent executing is recorded for results fetched later.
+		"""
+		if cursor is None:
+			cursor = self.connection.cursor()
+		diagnostics = self.diagnostics
+		if diagnostics is not None:
+			connection = cursor.connection
+			start = perf_counter()
+		if many:
+			cursor.executemany(cmd, args)
+		else:
+			cursor.execute(cmd, args)
+		result = cursor
+		if fetch is not None:
+			result = cursor.fetchone() if fetch == "one" else cursor.fetchall()
+			cursor.close()
+		if diagnostics is not None:
+			elapsed = perf_counter() - start
+			diagnostics.Record(cmd, args, elapsed, many, connection)
+		return result
 
 	def CacheSize(self):
 		"""
-		Returns the size of the cache, which is just
-		the size of the shared memory.
+		Returns the estimated size of the cache in bytes.
 		"""
-		sz = 0
-		for key, item in self.cache.items():
-			sz += sys.getsizeof(key)
-			sz += sys.getsizeof(item)
-		return sz
+		return self.cache.Size()
+
+	def CacheStats(self) -> dict:
+		"""
+		Returns the number of entries, estimated bytes, hits, misses
+		and evictions of the cache.
+		"""
+		return self.cache.Stats()
 
 	def SharedMemorySize(self):
 		"""
@@ -280,19 +1114,197 @@ class SQL:
 		return sz
 
 	def ClearCache(self):
-		self.cache = {}
+		self.cache.Clear()
 
-	def __mark_deleted__(self, obj:object):
-		"""	If an DBObject is being deleted by the
-			Python garbage collector, remove it from
-			shared memory if it exists there.
+	def Transaction(self) -> Transaction:
 		"""
-		if self.use_sharedmemory:
-			type_name = type(obj).__name__
-			if type_name in self.sharedmemory.keys():
-				sharedmem_type = self.sharedmemory[type_name]
-				if obj.dbid in sharedmem_type.keys():
-					sharedmem_type.pop(obj.dbid)
+		Returns a context manager that groups writes into a single
+		transaction:
+
+		with SQL.Get().Transaction():
+			...
+
+		Calls inside the block don't commit, regardless of their
+		commit argument. The changes are committed when the outermost
+		block exits, or rolled back if an exception escapes a block,
+		in which case the shared memory and cache are restored too.
+		"""
+		return Transaction(self)
+
+	def BulkLoad(self, tables=None) -> BulkLoad:
+		"""
+		Returns a context manager for loading large amounts of data
+		into tables quickly:
+
+		with SQL.Get().BulkLoad([Crew, Vessel]):
+			...
+
+		See the BulkLoad class for what it changes while loading.
+		Don't use it while other connections are writing to the DB.
+
+		Arguments:
+
+		tables	-- Classes of the tables to load (default: all of them).
+		"""
+		if tables is None:
+			tables = self.tables
+		return BulkLoad(self, list(tables))
+
+	def __owner__(self, data_class:type):
+		"""
+		Returns the DB that writes the rows of a class: this one,
+		unless the class is bound to another.
+		"""
+		return data_class.__dict__.get("__sql_db__", self)
+
+	def __autocommit__(self, commit:bool):
+		"""
+		Commits if requested, unless we're inside a transaction.
+		"""
+		if commit and len(self.transactions) == 0:
+			self.connection.commit()
+			self.__committed__()
+
+	def __written__(self, table:str):
+		"""
+		Records a write to table on the writer connection. Cached
+		results of the table are invalidated now, and again once the
+		write is committed (see __committed__), since until then the
+		reader connections of other threads still see the previous rows.
+		"""
+		with self.memory_lock:
+			tables = self.pending.get(self.connection)
+			if tables is None:
+				tables = self.pending[self.connection] = set()
+			tables.add(table)
+			self.writers[threading.get_ident()] = self.connection
+			self.cache.Invalidate(table)
+
+	def __committed__(self):
+		"""
+		Invalidates the tables written to since the last commit or
+		rollback, unless the writer connection is still in a transaction.
+		"""
+		if self.connection.in_transaction:
+			return
+		with self.memory_lock:
+			for table in self.pending.pop(self.connection, ()):
+				self.cache.Invalidate(table)
+			for thread in [ t for t, c in self.writers.items() if c is self.connection ]:
+				del self.writers[thread]
+
+	def __cacheable__(self) -> bool:
+		"""
+		Returns whether queries of the current thread may use the
+		cache. They may not while it has uncommitted writes, if other
+		connections share the cache, so that they never see results
+		that might be rolled back.
+		"""
+		if not self.use_cache:
+			return False
+		if self.pool or self.twinned:
+			return threading.get_ident() not in self.writers
+		return True
+
+	def __read_generation__(self, table:str):
+		"""
+		Returns the generation of table (see QueryCache) before reading
+		from it, or None if the rows read are sure to be current, i.e.
+		unless they're read through another connection than the one 
+		with pending writes, e.g. the reader connection of a thread.
+		"""
+		connection = self.__reader__()
+		with self.memory_lock:
+			if connection is self.connection and all( c is connection for c in self.pending ):
+				return None
+		return self.cache.Generations( ( table, ) )
+
+	def __journal__(self, action:str, item):
+		"""
+		Records a write made inside a transaction, so that it can be
+		undone in memory if the transaction is rolled back.
+		"""
+		if len(self.transactions) > 0:
+			self.transactions[-1].append( ( action, item ) )
+
+	def __rollback_journal__(self, journal:list):
+		"""
+		Restores the in-memory state after a transaction is rolled back.
+		"""
+		tables = set()
+		reloaded = set()
+		for action, item in reversed(journal):
+			if action == "import":
+				# rows imported in bulk into the table of a class
+				tables.add(item.__tablename__)
+				continue
+			elif action == "list":
+				# a List the deleted item was in, or one of its own
+				my_list, state = item
+				my_list.__restore__(state)
+				continue
+			elif action == "reference":
+				# a Reference to the deleted item
+				ref, dbid = item
+				ref.__sql_converter__(dbid)
+				continue
+			tables.add(item.__class__.__tablename__)
+			idict = item.__dict__
+			sharedmem_type = self.sharedmemory.get(item.__class__.__name__)
+			if action == "add":
+				# the item is no longer in the DB
+				if sharedmem_type is not None:
+					sharedmem_type.pop(idict["dbid"], None)
+					self.pinned.pop( ( item.__class__, idict["dbid"] ), None )
+				idict.pop("dbid", None)
+				idict.pop("__snapshot__", None)
+				idict.pop("__dirty__", None)
+			elif action == "update":
+				# restore the values it had before the transaction
+				if id(item) not in reloaded:
+					reloaded.add(id(item))
+					self.__reload__(item)
+			elif action == "delete":
+				if sharedmem_type is not None:
+					self.__remember__(item)
+		# results read inside the transaction may have seen its writes
+		for table in tables:
+			self.cache.Invalidate(table)
+
+	def __reload__(self, item):
+		"""
+		Copies the row of an item in the DB back into it, e.g. after
+		a rollback. If it has no row, it's no longer tracked, so its 
+		whole row is written the next time it's updated.
+		"""
+		data_class = item.__class__
+		idict = item.__dict__
+		row = None
+		if idict.get("dbid", NULL_INT) != NULL_INT:
+			row = self.__run__(data_class.__sql_plan__.select_cmd, ( idict["dbid"], ), fetch="one")
+		if row is None:
+			idict.pop("__snapshot__", None)
+			idict.pop("__dirty__", None)
+		else:
+			SQL.CopyRowToData(data_class, row, item)
+
+	def __remember__(self, item):
+		"""
+		Stores an item in shared memory. Shared memory only holds
+		weak references, except for the pin_size most recently 
+		remembered items.
+		"""
+		data_class = item.__class__
+		dbid = item.dbid
+		with self.memory_lock:
+			self.sharedmemory[data_class.__name__][dbid] = item
+			if self.pin_size > 0:
+				pinned = self.pinned
+				key = ( data_class, dbid )
+				pinned[key] = item
+				pinned.move_to_end(key)
+				if len(pinned) > self.pin_size:
+					pinned.popitem(last=False)
 
 	def MakeColumns(data_class: type):
 		"""
@@ -308,7 +1320,7 @@ class SQL:
 		annotations = data_class.__annotations__
 		for var_name, var_type in annotations.items():
 			classname = ""
-			if hasattr(var_type, "__name__"):
+			if get_origin(var_type) is None:
 				classname = var_type.__name__
 			else:
 				# Reference or List
@@ -330,38 +1342,109 @@ class SQL:
 		return sql_columns
 
 	def ColumnValuesInString(data_class:type) -> str:
+		column_names = [ column[0] for column in data_class.__sql_columns__ ]
+		return (
+			f"({', '.join(column_names)})",
+			f"({', '.join('?' * len(column_names))})"
+		)
+
+	def MakePlan(data_class:type) -> TablePlan:
+		"""
+		Compiles the insert/update/delete/select statements of a
+		data class, along with the positional column layout used
+		to extract row values from its instances.
+		"""
+		table_name = data_class.__tablename__
 		sql_columns = data_class.__sql_columns__
+		annotations = data_class.__annotations__
 
-		column_cmd = ["("]
-		values_cmd = ["("]
-		last_column_index = len(sql_columns) - 1
-		for i in range(last_column_index):
-			column_name = sql_columns[i][0]
-			column_cmd.append(f"{column_name},")
-			values_cmd.append("?,")
-		column_cmd.append(f"{sql_columns[last_column_index][0]})")
-		values_cmd.append("?)")
-		return (
-			"".join(column_cmd), 
-			"".join(values_cmd)
+		columns = tuple( column[0] for column in sql_columns )
+		defaults = tuple( SQL.TYPE_DEFAULT[column[1]] for column in sql_columns )
+
+		adapters = []
+		custom = []
+		references = []
+		for index, name in enumerate(columns):
+			if name not in annotations:
+				continue
+			var_type = annotations[name]
+			origin = get_origin(var_type)
+			if origin is not None:
+				var_type = origin
+				if origin.__name__ == "Reference":
+					references.append(name)
+			if hasattr(var_type, "__sql_adapter__"):
+				adapters.append( ( index, name, var_type.__sql_adapter__ ) )
+			elif var_type.__name__ in SQL.TYPE_ADAPTERS:
+				custom.append( ( index, name, SQL.TYPE_ADAPTERS[var_type.__name__] ) )
+
+		if len(columns) > 0:
+			colvals = SQL.ColumnValuesInString(data_class)
+			insert_cmd = f"insert into {table_name} {colvals[0]} values {colvals[1]}"
+			insert_dbid_cmd = f"insert into {table_name} (dbid, {colvals[0][1:]} values (?, {colvals[1][1:]}"
+			set_str = ", ".join( f"{name} = ?" for name in columns )
+			update_cmd = f"update {table_name} set {set_str} where dbid = ?"
+		else:
+			insert_cmd = f"insert into {table_name} default values"
+			insert_dbid_cmd = f"insert into {table_name} (dbid) values (?)"
+			update_cmd = ""
+
+		layout = [ [ name, default, None, None ] for name, default in zip(columns, defaults) ]
+		for index, name, adapter in adapters:
+			layout[index][2] = adapter
+		for position, ( index, name, adapter ) in enumerate(custom):
+			layout[index][3] = position
+
+		return TablePlan(
+			table_name	= table_name,
+			columns		= columns,
+			column_index= { name : index for index, name in enumerate(columns) },
+			defaults	= defaults,
+			adapters	= tuple(adapters),
+			custom		= tuple(custom),
+			layout		= tuple( tuple(column) for column in layout ),
+			references	= frozenset(references),
+			insert_cmd	= insert_cmd,
+			insert_dbid_cmd = insert_dbid_cmd,
+			update_cmd	= update_cmd,
+			delete_cmd	= f"delete from {table_name} where dbid = ?",
+			select_cmd	= f"select * from {table_name} where dbid = ?",
+			update_cmds	= {},
+			row_types	= {}
 		)
 
 	def RegisterTables(self, data_classes:list):
 		"""
 		Registers the classes that will be used as tables
-		in the DB. Should be run only once.
+		in the DB, and binds them to it (see SQL.For). Should be 
+		run only once per DB.
+
+		Classes can be spread over several DBs, by registering each
+		group with its own DB. Classes that refer to each other must
+		be prepared together first:
+
+		SQL.PrepareTables([ VesselClass, Vessel, Crew, HistoryString ])
+		classes_db.RegisterTables([ VesselClass ])
+		main_db.RegisterTables([ Vessel, Crew, HistoryString ])
 		"""
-		self.tables = data_classes
+		SQL.PrepareTables(data_classes)
 		for data_class in data_classes:
-			dc_name = data_class.__name__
-
-			# initialize shared memory
-			if self.use_sharedmemory:
-				self.sharedmemory[dc_name] = {}
+			SQL.Bind(data_class, self)
+		self.OpenTables(data_classes)
 
+	def PrepareTables(data_classes:list):
+		"""
+		Detects the columns, foreign keys and indexes of classes, and
+		compiles their statements. Classes that have already been 
+		prepared, e.g. for another DB, are skipped.
+		"""
+		data_classes = [ dc for dc in data_classes if "__sql_plan__" not in dc.__dict__ ]
+		for data_class in data_classes:
 			# initialize table name
 			if "__tablename__" not in data_class.__dict__.keys():
-				data_class.__tablename__ = f"{dc_name.lower()}_table"
+				data_class.__tablename__ = f"{data_class.__name__.lower()}_table"
+			if data_class not in SQL.TABLES:
+				SQL.TABLES.append(data_class)
 
 		for data_class in data_classes:
 			# initialize column names
@@ -384,20 +1467,92 @@ class SQL:
 						)
 			data_class.__foreign_keys__ = foreign_keys
 		
-		# now that columns are finalized, cache column name + args
+		# now that columns are finalized, compile the statement plans
 		for data_class in data_classes:
-			data_class.__column_values__ = SQL.ColumnValuesInString(
-				data_class=data_class
-			)
-		
+			data_class.__sql_plan__ = SQL.MakePlan(data_class)
+			data_class.__sql_indexes__ = SQL.MakeIndexes(data_class)
+
+	def OpenTables(self, data_classes:list):
+		"""
+		Uses the tables of prepared classes with this DB, creating
+		them if the DB is new.
+		"""
+		self.tables = list(data_classes)
+		# initialize shared memory
+		if self.use_sharedmemory:
+			for data_class in data_classes:
+				self.sharedmemory[data_class.__name__] = WeakValueDictionary()
+
 		if self.will_init_tables:
 			self.CreateTables()
+		if not self.read_only:
+			self.CreateIndexes()
 			
 	def CreateTables(self):
 		for data_class in self.tables:
 			if len(data_class.__sql_columns__) > 0:
 				self.CreateTable(data_class)
 
+	def MakeIndexes(data_class:type) -> tuple:
+		"""
+		Collects the secondary indexes of a class: those declared in
+		its __indexes__, followed by one on each of its references
+		and one on the columns of each list it belongs to.
+		"""
+		table_name = data_class.__tablename__
+		column_names = set( column[0] for column in data_class.__sql_columns__ )
+		column_names.add("dbid")
+
+		declared = list(data_class.__dict__.get("__indexes__", []))
+		declared += [ Index( ( fk[0], ) ) for fk in data_class.__foreign_keys__ ]
+		declared += data_class.__dict__.get("__list_indexes__", [])
+
+		indexes = []
+		names = set()
+		for index in declared:
+			if type(index) == str:
+				index = Index( ( index, ) )
+			elif type(index) != Index:
+				index = Index( tuple(index) )
+			missing = [ name for name in index.columns if name not in column_names ]
+			if len(missing) > 0:
+				print(f"WARNING: can't index {missing[0]}, not a column of {data_class.__name__}!")
+				continue
+			if index.name == "":
+				index = index._replace(
+					name = "_".join( ( table_name, ) + tuple(index.columns) + ( "idx", ) )
+				)
+			# skip indexes that have already been declared
+			if index.name in names:
+				continue
+			names.add(index.name)
+			indexes.append(index)
+		return tuple(indexes)
+
+	def CreateIndexes(self):
+		"""
+		Creates the secondary indexes of all tables, unless they
+		already exist.
+		"""
+		for data_class in self.tables:
+			if len(data_class.__sql_columns__) == 0:
+				continue
+			for index in data_class.__sql_indexes__:
+				self.CreateIndex(data_class, index)
+		self.connection.commit()
+
+	def CreateIndex(self, data_class:type, index:Index):
+		unique_str = "unique " if index.unique else ""
+		where_str = f" where {index.where}" if index.where != "" else ""
+		cmd = (
+			f"create {unique_str}index if not exists {index.name} on "
+			f"{data_class.__tablename__} ({', '.join(index.columns)}){where_str}"
+		)
+		try:
+			self.connection.execute(cmd)
+		except sqlite3.Error as e:
+			print(f"WARNING: couldn't create index {index.name}: {e}")
+
 	def CreateTable(self, data_class:type):
 		"""
 		Creates a table in the DB from a class.
@@ -424,9 +1579,14 @@ class SQL:
 			f"{column_name(column)} {column_type(column)}"
 		)
 
-		# establish foreign keys
+		# establish foreign keys, except to tables in other DBs, 
+		# which sqlite can't check
+		local = { dc.__tablename__ : dc for dc in self.tables }
 		foreign_keys = data_class.__foreign_keys__
 		for foreign_key in foreign_keys:
+			parent = local.get(foreign_key[1])
+			if parent is None or self.__owner__(parent) is not self:
+				continue
 			cmd_terms.append(
 				f", foreign key({foreign_key[0]}) references {foreign_key[1]}(dbid) on delete set null"
 			)
@@ -438,18 +1598,22 @@ class SQL:
 		self.connection.execute(cmd)
 		self.connection.commit()
 
+	@Synchronized
 	def Clear(self, data_class:type):
 		"""
 		Drops the table for a corresponding class.
 		"""
 		table_name = data_class.__tablename__
 		# clear table first
-		self.connection.execute(f"delete from {table_name}")
-		self.connection.commit()
+		self.__run__(f"delete from {table_name}").close()
+		self.__written__(table_name)
+		self.__autocommit__(True)
 		
 		# Clear our shared memory
 		if self.use_sharedmemory:
-			self.sharedmemory[data_class.__name__] = {}
+			self.sharedmemory[data_class.__name__] = WeakValueDictionary()
+			for key in [ key for key in self.pinned if key[0] == data_class ]:
+				self.pinned.pop(key)
 
 	def TableLength(self, data_class:type) -> int:
 		"""
@@ -457,19 +1621,18 @@ class SQL:
 		"""
 		table_name = data_class.__tablename__
 		cmd = f"select count(1) from {table_name}"
-		cursor = self.connection.cursor()
-		cursor.execute(cmd)
-		size = cursor.fetchone()[0]
-		cursor.close()
-		return size
+		return self.__run__(cmd, cursor=self.__reader__().cursor(), fetch="one")[0]
 
+	@Synchronized
 	def Commit(self):
 		"""
 		Manually commit any changes made. Useful if one has
 		deferred other changes.
 		"""
 		self.connection.commit()
+		self.__committed__()
 
+	@Synchronized
 	def Add(self, item, commit=True):
 		"""
 		Adds the item as a row to its corresponding table.
@@ -478,194 +1641,478 @@ class SQL:
 		immediately committed to the DB.
 		"""
 		data_class = item.__class__
-
-		table_name = data_class.__tablename__
-		sql_columns = data_class.__sql_columns__
 		idict = item.__dict__
-		valid_columns = idict.keys()
 
-		if "dbid" in valid_columns:
-			if item.dbid != NULL_INT:
-				self.Update(item, commit=commit)
+		if data_class not in self.tables:
+			owner = self.__owner__(data_class)
+			if owner is not self:
+				owner.Add(item, commit)
 				return
-		
-		attr_list = []
-		# all attributes other than the dbid
-		for column in sql_columns:
-			var_name = column[0]
-			var_type = column[1]
-			# save it if there's a value;
-			# otherwise set it to a default value
-			if var_name in idict.keys():
-				var_value = idict[ var_name ]
-				if hasattr(var_value, "__sql_adapter__"):
-					var_value = var_value.__sql_adapter__()
-				attr_list.append( var_value )
-			else:
-				attr_list.append( 
-					SQL.TYPE_DEFAULT[var_type]
-				)
-	
-		# save them to the table
-		colvals = data_class.__column_values__
-		cmd = f"insert into {table_name} {colvals[0]} values {colvals[1]}"
-		cursor = self.connection.cursor()
-		cursor.execute(cmd, attr_list)
+
+		if idict.get("dbid", NULL_INT) != NULL_INT:
+			self.Update(item, commit=commit)
+			return
+
+		# save all attributes other than the dbid to the table;
+		# missing attributes are saved as default values
+		plan = data_class.__sql_plan__
+		start = self.__clock__()
+		adapted = plan.Adapted(idict)
+		cursor = self.__run__(plan.insert_cmd, plan.RowValues(idict, adapted))
 		# Set the item dbid
 		item.dbid = cursor.lastrowid
+		cursor.close()
+		if start is not None:
+			self.__observe__(start, "Add", data_class, plan.insert_cmd, 1)
+		plan.Snapshot(idict, adapted)
+		self.__journal__("add", item)
+		self.__written__(plan.table_name)
 
 		# add the item to shared memory
 		if self.use_sharedmemory:
-			self.sharedmemory[data_class.__name__][item.dbid] = item
-
-		cursor.close()
+			self.__remember__(item)
 
 		# finally, add lists
-		for list in item.__get_lists__():
-			list.__add_to_db__()
+		self.__write_lists__((item,))
 
-		if commit:
-			self.connection.commit()
+		self.__autocommit__(commit)
 
+	@Synchronized
 	def AddList(self, i_list:list, commit=True):
 		"""
 		Adds the items in i_list as rows to their corresponding 
-		tables.
+		tables. Items are grouped by class, and each group is 
+		inserted in bulk. Items that are already in the DB are
+		updated instead.
 
 		If commit is False, then the change will not be
 		immediately committed to the DB.
 		"""
+		new_groups = {}
+		update_groups = {}
+		seen = set()
 		for item in i_list:
-			self.Add(item, commit=False)
+			# an item listed twice is only written once
+			if id(item) in seen:
+				continue
+			seen.add(id(item))
+			data_class = item.__class__
+			if item.__dict__.get("dbid", NULL_INT) != NULL_INT:
+				groups = update_groups
+			else:
+				groups = new_groups
+			if data_class not in groups:
+				groups[data_class] = []
+			groups[data_class].append(item)
+
+		for groups in ( update_groups, new_groups ):
+			for data_class in list(groups.keys()):
+				owner = self.__owner__(data_class)
+				if owner is not self:
+					# rows of tables in other DBs are written, and
+					# committed, by those DBs
+					owner.AddList(groups.pop(data_class))
+
+		for items in update_groups.values():
+			self.UpdateList(items, commit=False)
+
+		added = []
+		for data_class, items in new_groups.items():
+			skipped = self.__insert_list__(data_class, items)
+			if len(skipped) > 0:
+				# added meanwhile, e.g. through the Reference of another 
+				# item, so even immutable ones may be brought up to date
+				self.UpdateList(skipped, force_update=True, commit=False)
+				skipped = set(map(id, skipped))
+				items = [ item for item in items if id(item) not in skipped ]
+			added += items
+
+		# finally, add the lists of all new items at once
+		self.__write_lists__(added)
+
+		self.__autocommit__(commit)
+
+	def __insert_list__(self, data_class:type, items:list) -> list:
+		"""
+		Inserts new items of a single class with executemany, and
+		assigns them contiguous dbids. Returns the items that were
+		skipped, see __insert_rows__.
+		"""
+		clock = self.__clock__()
+		skipped = self.__insert_rows__(data_class, items)
+		if clock is not None:
+			plan = data_class.__sql_plan__
+			rows = len(items) - len(skipped)
+			self.__observe__(clock, "AddList", data_class, plan.insert_dbid_cmd, rows)
+		return skipped
+
+	def __insert_rows__(self, data_class:type, items:list, dbids=None) -> list:
+		"""
+		Inserts new items of a single class, BULK_CHUNK rows per
+		executemany call, with the given dbids. The caller must hold 
+		the write lock.
+
+		If no dbids are given, the first row of each chunk is inserted
+		normally to reserve the next dbid. Since the table uses 
+		AUTOINCREMENT and we hold the write lock, every dbid above it
+		is free, so the remaining rows are inserted with explicit, 
+		contiguous dbids.
+
+		Adapting the values of a row may add other items, e.g. those
+		of its References, which can be items of the list. Items that
+		are already in the DB by the time their chunk is inserted are 
+		skipped, and returned so that they can be updated instead.
+		"""
+		plan = data_class.__sql_plan__
+		self.__written__(plan.table_name)
+		cursor = self.connection.cursor()
+		skipped = []
+		added = []
+		for start in range(0, len(items), SQL.BULK_CHUNK):
+			chunk = items[start:start+SQL.BULK_CHUNK]
+			# adapt every row of the chunk before reserving dbids
+			values = []
+			for item in chunk:
+				idict = item.__dict__
+				if idict.get("dbid", NULL_INT) == NULL_INT:
+					adapted = plan.Adapted(idict)
+					values.append( ( plan.RowValues(idict, adapted), adapted ) )
+				else:
+					values.append(None)
+			rows = []
+			for i, item in enumerate(chunk):
+				if values[i] is None or item.__dict__.get("dbid", NULL_INT) != NULL_INT:
+					skipped.append(item)
+				else:
+					rows.append( ( item, None if dbids is None else dbids[start + i] ) + values[i] )
+			if len(rows) == 0:
+				continue
+
+			if dbids is None:
+				item, dbid, row, adapted = rows[0]
+				self.__run__(plan.insert_cmd, row, cursor)
+				first_dbid = cursor.lastrowid
+				self.__inserted__(plan, item, first_dbid, adapted)
+				added.append(item)
+				rows = [
+					( item, first_dbid + n, row, adapted ) 
+					for n, ( item, dbid, row, adapted ) in enumerate(rows[1:], 1)
+				]
+			arg_list = []
+			for item, dbid, row, adapted in rows:
+				arg_list.append( [dbid] + row )
+				self.__inserted__(plan, item, dbid, adapted)
+				added.append(item)
+			if len(arg_list) > 0:
+				self.__run__(plan.insert_dbid_cmd, arg_list, cursor, many=True)
+		cursor.close()
 
-		if commit:
-			self.connection.commit()
+		# add the items to shared memory
+		if self.use_sharedmemory:
+			for item in added:
+				self.__remember__(item)
+		return skipped
+
+	def __inserted__(self, plan:TablePlan, item, dbid:int, adapted:tuple):
+		"""
+		Marks an item as written to the DB with dbid, see Snapshot.
+		"""
+		idict = item.__dict__
+		idict["dbid"] = dbid
+		plan.Snapshot(idict, adapted)
+		self.__journal__("add", item)
+
+	def ImportValue(plan:TablePlan, data_class:type, name:str):
+		"""
+		Returns the function that converts an imported value of a
+		column into a sqlite value. Strings, as read from a CSV file,
+		are parsed according to the type of the column, and empty
+		strings are replaced with the default value of the column.
+		"""
+		sql_type = dict(data_class.__sql_columns__)[name]
+		var_type = data_class.__annotations__.get(name)
+		default = plan.defaults[plan.column_index[name]]
+
+		if name in plan.references:
+			def convert(val):
+				if val is None or val == "" or val == NULL_INT:
+					# store null, which satisfies the foreign key
+					return None
+				if hasattr(val, "dbid"):
+					return val.dbid
+				return int(val)
+		elif var_type is bool:
+			def convert(val):
+				if type(val) == str:
+					if val == "":
+						return default
+					return int( val.strip().lower() in ( "1", "true", "yes" ) )
+				return int(val)
+		elif sql_type in ( "integer", "real" ):
+			parse = int if sql_type == "integer" else float
+			def convert(val):
+				if type(val) == str:
+					return default if val == "" else parse(val)
+				return val
+		elif var_type is not None and var_type.__name__ in SQL.TYPE_ADAPTERS:
+			# strings are taken to be already in the stored format
+			adapter = SQL.TYPE_ADAPTERS[var_type.__name__]
+			def convert(val):
+				if isinstance(val, var_type):
+					return adapter(val)
+				return default if val == "" else val
+		elif sql_type != "text":
+			# dates and timestamps, which sqlite parses from ISO strings
+			def convert(val):
+				return default if val == "" else val
+		else:
+			convert = None
+		return convert
+
+	@Synchronized
+	def BulkImport(self, data_class:type, source) -> range:
+		"""
+		Imports rows into the table of a class without creating 
+		objects, and returns the range of their dbids. Rows are 
+		inserted in chunks, in a single transaction. Columns which
+		aren't given are set to their default value.
+
+		Arguments:
+
+		source	-- Either a dict of column name -> sequence of values
+				   (e.g. lists, or the NumPy arrays of ToArrays), or the
+				   path of a CSV file whose header holds the column names.
+				   Values of custom types may be given either as objects,
+				   or as strings in their stored format.
+		"""
+		plan = data_class.__sql_plan__
+		if type(source) == dict:
+			names = list(source.keys())
+			columns = []
+			for column in source.values():
+				columns.append( column.tolist() if hasattr(column, "tolist") else list(column) )
+			lengths = set( len(column) for column in columns )
+			if len(lengths) > 1:
+				print(f"WARNING: columns imported into {data_class.__name__} differ in length!")
+				return range(0)
+			rows = zip(*columns)
+			csv_file = None
+		else:
+			csv_file = open(source, newline="")
+			rows = csv.reader(csv_file)
+			names = next(rows, [])
+
+		try:
+			for name in names:
+				if name not in plan.column_index:
+					print(f"WARNING: {name} is not a column of {data_class.__name__}!")
+					return range(0)
+
+			# position of each column in the source, and its conversion
+			sources = [ None ] * len(plan.columns)
+			converters = [ None ] * len(plan.columns)
+			for position, name in enumerate(names):
+				index = plan.column_index[name]
+				sources[index] = position
+				converters[index] = SQL.ImportValue(plan, data_class, name)
+			defaults = list(plan.defaults)
+			for name in plan.references:
+				defaults[plan.column_index[name]] = None
+			layout = tuple(zip(sources, converters, defaults))
+
+			def MakeRow(row):
+				values = []
+				for position, convert, default in layout:
+					if position is None:
+						values.append(default)
+					elif convert is None:
+						values.append(row[position])
+					else:
+						values.append(convert(row[position]))
+				return values
+
+			first_dbid = None
+			count = 0
+			start = self.__clock__()
+			with self.Transaction():
+				self.__written__(plan.table_name)
+				self.__journal__("import", data_class)
+				cursor = self.connection.cursor()
+				for row in rows:
+					# reserve the next dbid, then insert the remaining
+					# rows with explicit, contiguous dbids (see __insert_rows__)
+					self.__run__(plan.insert_cmd, MakeRow(row), cursor)
+					first_dbid = cursor.lastrowid
+					count = 1
+					break
+				while first_dbid is not None:
+					arg_list = []
+					for row in rows:
+						arg_list.append( [ first_dbid + count ] + MakeRow(row) )
+						count += 1
+						if len(arg_list) == SQL.BULK_CHUNK:
+							break
+					if len(arg_list) == 0:
+						break
+					self.__run__(plan.insert_dbid_cmd, arg_list, cursor, many=True)
+				cursor.close()
+			if start is not None:
+				self.__observe__(start, "BulkImport", data_class, plan.insert_dbid_cmd, count)
+		finally:
+			if csv_file is not None:
+				csv_file.close()
+
+		if first_dbid is None:
+			return range(0)
+		return range(first_dbid, first_dbid + count)
+
+	def __write_lists__(self, items):
+		"""
+		Writes the children of every List in items, in bulk.
+		"""
+		children = []
+		for item in items:
+			for list in item.__get_lists__():
+				children += list.__collect_for_db__()
+		if len(children) > 0:
+			self.AddList(children, commit=False)
 
+	@Synchronized
 	def Delete(self, item, force_remove=False, commit=True):
 		data_class = item.__class__
 		dc_name = data_class.__name__
+		if data_class not in self.tables:
+			owner = self.__owner__(data_class)
+			if owner is not self:
+				owner.Delete(item, force_remove, commit)
+				return
 		if data_class.__immutable__ and not force_remove:
 			print(f"WARNING: Can't delete immutable type {dc_name}!")
 			return
 
 		# First unlink any items in lists connected to this
 		for list in item.__get_lists__():
+			if len(self.transactions) > 0:
+				list.__check_loaded__()
+				self.__journal__("list", ( list, list.__state__() ))
 			list.__delete_from_db__()
 
 		# Now delete it from the table
-		table_name = data_class.__tablename__
-		cmd = f"delete from {table_name} where dbid = ?"
-		self.connection.execute( cmd, (item.dbid,) )
+		start = self.__clock__()
+		delete_cmd = data_class.__sql_plan__.delete_cmd
+		self.__run__( delete_cmd, (item.dbid,) ).close()
+		if start is not None:
+			self.__observe__(start, "Delete", data_class, delete_cmd, 1)
+		self.__journal__("delete", item)
 		
-		if self.use_cache:
-			# clear the item from any appearance in the cache
-			to_remove = []
-			for h, val in self.cache.items():
-				if type(val) == list:
-					if item in val:
-						val.remove(item)
-						if len(val) == 0:
-							to_remove.append(h)
-				else:
-					if item == val:
-						to_remove.append(h)
-			for h in to_remove:
-				self.cache.pop(h)
-
-		if self.use_sharedmemory:
-			# remove it from shared memory
-			if item.dbid in self.sharedmemory[dc_name].keys():
-				self.sharedmemory[dc_name].pop(item.dbid)
-			
-			# remove it from any References in shared memory
-			for dc in self.tables:
-				for fk in dc.__foreign_keys__:
-					if fk[1] == dc_name:
-						for v in self.sharedmemory[dc.__name__].values():
-							ref = v.__get_reference__(fk[0])
-							if ref.ref_id == item.dbid:
-								ref.__set__(None)
-
-			# remove it from any Lists in shared memory 
-			for name, vals in self.sharedmemory.items():
-				if name == dc_name:
-					continue
+		table_name = data_class.__tablename__
+		self.__written__(table_name)
+
+		for dc in self.tables:
+			referencing = [ fk[0] for fk in dc.__foreign_keys__ if fk[1] == table_name ]
+			if len(referencing) > 0:
+				# the DB sets references to the item to null
+				self.__written__(dc.__tablename__)
+			if not self.use_sharedmemory:
+				continue
+
+			# readers may be adding to shared memory meanwhile
+			with self.memory_lock:
+				# remove it from any References in shared memory
+				for ref_name in referencing:
+					for v in self.sharedmemory[dc.__name__].values():
+						ref = v.__get_reference__(ref_name)
+						if ref.ref_id == item.dbid:
+							self.__journal__("reference", ( ref, item.dbid ))
+							ref.__set__(None)
+
+				# remove it from any Lists in shared memory 
 				for ld in dc.__list_defs__:
 					if ld[1] == dc_name:
-						for val in vals.values():
+						for val in self.sharedmemory[dc.__name__].values():
 							my_list = val.__dict__[ ld[0] ]
+							if len(self.transactions) > 0 and my_list.__is_loaded__() and item in my_list.items:
+								self.__journal__("list", ( my_list, my_list.__state__() ))
 							my_list.__erase_item__(item)
+
+		if self.use_sharedmemory:
+			# remove it from shared memory
+			with self.memory_lock:
+				self.sharedmemory[dc_name].pop(item.dbid, None)
+				self.pinned.pop( ( data_class, item.dbid ), None )
 		
-		if commit:
-			self.connection.commit()
+		self.__autocommit__(commit)
 
+	@Synchronized
 	def Update(self, item, force_update=False, commit=True):
 		"""
-		Updates the row of item in its corresponding table.
+		Updates the row of item in its corresponding table. Only
+		the columns that changed since the item was last read or 
+		written are updated; if none did, no statement is issued.
 
 		If commit is False, then the change will not be
 		immediately committed to the DB.
 		"""
 		data_class = item.__class__
+		idict = item.__dict__
 
-		table_name = data_class.__tablename__
-		sql_columns = data_class.__sql_columns__
-		item_dict = item.__dict__
-		valid_columns = item_dict.keys()
-
-		if "dbid" in valid_columns:
-			# construct the sql update command
-			dbid = item.dbid
+		if data_class not in self.tables:
+			owner = self.__owner__(data_class)
+			if owner is not self:
+				owner.Update(item, force_update, commit)
+				return
 
+		if "dbid" in idict:
 			if data_class.__immutable__ and not force_update:
 				print(f"WARNING: Can't update immutable type {data_class.__name__}!")
 				return
 
-			update_list = []
-
-			column_name = lambda c : c[0]
-			column_type = lambda c : c[1]
-			
-			def add_to_column_list(column):
-				name = column_name(column)
-				if name in valid_columns:
-					val = item_dict[name]
-					if hasattr(val, "__sql_adapter__"):
-						val = val.__sql_adapter__()
-					update_list.append( val )
-				else:
-					update_list.append(
-						SQL.TYPE_DEFAULT[ column_type(column) ]
-					)
-
-			cmd_terms = [f"update {table_name} set "]
-			col_range = len(sql_columns) - 1
-			for i in range(col_range ):
-				column = sql_columns[i]
-				add_to_column_list(column)
-				cmd_terms.append(f"{column_name(column)} = ?, ")
-			column = sql_columns[col_range]
-			add_to_column_list(column)
-			cmd_terms.append(f"{column_name(column)} = ? where dbid = ?")
-			update_list.append( dbid )
-			cmd = "".join(cmd_terms)
-
-			# update the db
-			self.connection.execute(cmd, tuple(update_list) )
+			plan = data_class.__sql_plan__
+			cmd, values, adapted = SQL.UpdateArgs(plan, idict)
+			if cmd is not None:
+				# update the db
+				start = self.__clock__()
+				self.__run__(cmd, values).close()
+				if start is not None:
+					self.__observe__(start, "Update", data_class, cmd, 1)
+				plan.Snapshot(idict, adapted)
+				self.__journal__("update", item)
+				self.__written__(plan.table_name)
 
 			# Finally, update lists
-			for list in item.__get_lists__():
-				list.__update_to_db__()
+			self.__write_lists__((item,))
 
-			if commit:
-				self.connection.commit()
+			self.__autocommit__(commit)
 		else:
 			self.Add(item, commit=commit)
+
+	def UpdateArgs(plan:TablePlan, idict:dict) -> tuple:
+		"""
+		Returns the update statement and its arguments for the dirty
+		columns of an item, or ( None, None, None ) if the item is 
+		clean, along with the adapted values of its custom types to
+		snapshot once it's written. Only the values of dirty columns
+		are computed.
+		"""
+		dirty, adapted = plan.DirtyColumns(idict)
+		if dirty is None:
+			values = plan.RowValues(idict, adapted)
+			if len(values) == 0:
+				return ( None, None, None )
+			values.append(idict["dbid"])
+			return ( plan.update_cmd, values, adapted )
+		if len(dirty) == 0:
+			return ( None, None, None )
+		values = plan.ColumnValues(idict, dirty, adapted)
+		values.append(idict["dbid"])
+		return ( plan.UpdateCommand(dirty), values, adapted )
 	
+	@Synchronized
 	def UpdateList(self, item_list, force_update=False, commit=True):
 		"""
 		Updates the rows of the items in item_list in their 
-		corresponding tables.
+		corresponding tables. Items are grouped by the set of columns
+		that changed, and each group is updated with executemany.
 
 		If commit is False, then the change will not be
 		immediately committed to the DB.
@@ -674,85 +2121,50 @@ class SQL:
 			return
 
 		data_class 	= item_list[0].__class__
-		table_name 	= data_class.__tablename__
-		sql_columns = data_class.__sql_columns__
-
+		if data_class not in self.tables:
+			owner = self.__owner__(data_class)
+			if owner is not self:
+				owner.UpdateList(item_list, force_update, commit)
+				return
 		if data_class.__immutable__ and not force_update:
 			print(f"WARNING: Can't update immutable type {data_class.__name__}!")
 			return
 
-		arg_list = []
+		plan = data_class.__sql_plan__
+		arg_lists = {}
 		i_list = []
 		add_list = []
-		
-		column_name = lambda c : c[0]
-		column_type = lambda c : c[1]
-
-		# Build SQL command from first item
-		cmd_terms = [f"update {table_name} set "]
-		item = item_list[0]
-		col_range = len(sql_columns) - 1
-		for i in range(col_range ):
-			column = sql_columns[i]
-			cmd_terms.append(
-				f"{column_name(column)} = ?, "
-			)
-		column = sql_columns[col_range]
-		cmd_terms.append(
-			f"{column_name(column)} = ? where dbid = ?"
-		)
-		cmd = "".join(cmd_terms)
-
-		# Insert actual values to update
 		for item in item_list:
-			item_dict = item.__dict__
-			valid_columns = item_dict.keys()
-
-			if "dbid" in valid_columns:
-				# construct the sql update command
-				dbid = item.dbid
-
-				update_list = []
-				def add_to_column_list(column):
-					name = column_name(column)
-					if name in valid_columns:
-						val = item_dict[name]
-						if hasattr(val, "__sql_adapter__"):
-							val = val.__sql_adapter__()
-						update_list.append( val )
-					else:
-						update_list.append(
-							SQL.TYPE_DEFAULT[ column_type(column) ]
-						)
-
-				col_range = len(sql_columns) - 1
-				for i in range(col_range ):
-					column = sql_columns[i]
-					add_to_column_list(column)
-				column = sql_columns[col_range]
-				add_to_column_list(column)
-				update_list.append( dbid )
-
-				# Add this to the argument list
-				arg_list.append(tuple(update_list))
+			idict = item.__dict__
+			if "dbid" in idict:
+				cmd, values, adapted = SQL.UpdateArgs(plan, idict)
+				if cmd is not None:
+					if cmd not in arg_lists:
+						arg_lists[cmd] = []
+					arg_lists[cmd].append(values)
+					plan.Snapshot(idict, adapted)
+					self.__journal__("update", item)
 				# Add item to list of possible list containers
 				i_list.append(item)
 			else:
 				add_list.append(item)
 
-			# add to db any items that weren't in it
-			self.AddList(add_list, commit=commit)
-
-			# update the db
-			self.connection.executemany(cmd, arg_list)
+		# add to db any items that weren't in it
+		self.AddList(add_list, commit=False)
+
+		# update the db
+		for cmd, arg_list in arg_lists.items():
+			start = self.__clock__()
+			self.__run__(cmd, arg_list, many=True).close()
+			if start is not None:
+				self.__observe__(start, "UpdateList", data_class, cmd, len(arg_list))
+		if len(arg_lists) > 0:
+			self.__written__(plan.table_name)
 		
-			# Finally, update lists
-			for item in i_list:
-				for list in item.__get_lists__():
-					list.__update_to_db__()
+		# Finally, update lists
+		self.__write_lists__(i_list)
 
-			if commit:
-				self.connection.commit()
+		self.__autocommit__(commit)
 
 	def CopyRowToData(data_class:type, row:sqlite3.Row, existing_item=None):
 		"""
@@ -762,36 +2174,32 @@ class SQL:
 		If existing_item is None, then the method will allocate a new object.
 		Otherwise, it will copy the data into the attributes of existing_item.
 		"""
-		if existing_item == None:
+		if existing_item is None:
 			item = data_class()
 		else:
 			item = existing_item
 
-		annotations = data_class.__annotations__
-		for column_name in row.keys():
-			if column_name == "dbid":
-				item.dbid = row["dbid"]
+		references = data_class.__sql_plan__.references
+		idict = item.__dict__
+		for column_name, value in zip(row.keys(), row):
+			if column_name in references:
+				# if it's a reference, set the ref_id only
+				idict[column_name].__sql_converter__(value)
 			else:
-				# set the value
-				if column_name in annotations:
-					# if it's a reference, set the ref_id only
-					ref = item.__get_reference__(column_name)
-					if ref != None:
-						ref.__sql_converter__(row[column_name])
-						continue
-							
-				setattr(
-					item,
-					column_name, 
-					row[column_name]
-				)
+				idict[column_name] = value
+		data_class.__sql_plan__.Snapshot(idict)
 		# Mark lists as preexisting from db
 		item.__mark_lists_from_db__()
 		return item
 
-	def ProcessRow(self, data_class:str, row:sqlite3.Row):
+	def ProcessRow(self, data_class:str, row:sqlite3.Row, generation=None):
 		"""
 		Process an individual Row returned from the DB.
+
+		generation is that of the table before the row was read, see 
+		__read_generation__. If the table has been written to since,
+		or has uncommitted writes, the row may be older than the object
+		in shared memory, which is then returned as it is.
 		"""
 		dbid = row["dbid"]
 		dc_name = data_class.__name__
@@ -800,61 +2208,491 @@ class SQL:
 		# into the same block of memory. Otherwise, we
 		# make a new item, add it, then return
 		if self.use_sharedmemory:
-			if dbid in self.sharedmemory[dc_name].keys():
-				# in shared memory
-				item = self.sharedmemory[dc_name][dbid]
-				SQL.CopyRowToData(data_class, row, item)
-			else:
-				# not in shared memory already
-				item = SQL.CopyRowToData(data_class, row)
-				self.sharedmemory[dc_name][dbid] = item
+			with self.memory_lock:
+				item = self.sharedmemory[dc_name].get(dbid)
+				if generation is not None and self.__stale__(data_class, generation, item):
+					if item is None:
+						# not remembered, since it may be out of date
+						item = SQL.CopyRowToData(data_class, row)
+					return item
+				if item is not None:
+					# in shared memory
+					SQL.CopyRowToData(data_class, row, item)
+				else:
+					# not in shared memory already
+					item = SQL.CopyRowToData(data_class, row)
+				self.__remember__(item)
 		else:
 			item = SQL.CopyRowToData(data_class, row)
 		return item
 
-	def MakeSelectCommand(table_name:str, args:tuple, orderby="") -> str:
+	def __stale__(self, data_class:type, generation:tuple, item) -> bool:
+		"""
+		Returns whether a row of data_class read at generation may be
+		older than the DB or than item, its object in shared memory,
+		which has unsaved changes if it's dirty.
+		"""
+		table_name = data_class.__tablename__
+		connection = self.__reader__()
+		for other, tables in self.pending.items():
+			if other is not connection and table_name in tables:
+				return True
+		if self.cache.Generations( ( table_name, ) ) != generation:
+			return True
+		return item is not None and len(item.__dict__.get("__dirty__", ())) > 0
+
+	def MakeSelectCommand(table_name:str, args:str, orderby="", limit=None, offset=None, 
+		columns=None) -> str:
 		"""
-		Creates a SELECT command with WHERE query arguments, and 
-		optional ORDER BY.
+		Creates a SELECT command with WHERE query arguments (if any), 
+		and optional ORDER BY, LIMIT and OFFSET. Selects all columns
+		unless a tuple of columns is given. LIMIT and OFFSET are bound
+		parameters, so that every page of a query is the same statement:
+		their values, from LimitArgs, follow the query arguments.
 		"""
+		column_str = "*"
+		if columns is not None:
+			column_str = ", ".join(columns)
+		where_str = ""
+		if args != "":
+			where_str = f" where {args}"
 		order_str = ""
 		if orderby != "":
 			order_str = f" order by {orderby}"
-		return f"select * from {table_name} where {args}{order_str}"
-
-	def Select(self, data_class:type, args:tuple, orderby="") -> list:
+		limit_str = ""
+		if limit is not None or offset is not None:
+			limit_str = " limit ?"
+		if offset is not None:
+			limit_str += " offset ?"
+		return f"select {column_str} from {table_name}{where_str}{order_str}{limit_str}"
+
+	def LimitArgs(limit=None, offset=None) -> tuple:
+		"""
+		Returns the arguments of the LIMIT and OFFSET of a command
+		made by MakeSelectCommand.
+		"""
+		if offset is not None:
+			return ( -1 if limit is None else int(limit), int(offset) )
+		if limit is not None:
+			return ( int(limit), )
+		return ()
+
+	def Select(self, data_class:type, args:tuple, orderby="", prefetch=(), 
+		limit=None, offset=None, after_dbid=None, after=None, columns=None, use_cache=True) -> list:
 		"""
 		Selects data from the DB, and returns a list of objects.
 
 		Arguments:
 
-		args 	-- Produced by chaining Query functions.
-		orderby	-- Produced by chaining Query.Order* functions.
+		args 		-- Produced by chaining Query functions, or None to
+					   select all rows.
+		orderby		-- Produced by chaining Query.Order* functions.
+		prefetch	-- Names of relations to load for all results at once.
+		limit		-- Maximum number of rows to return.
+		offset		-- Number of rows to skip.
+		after_dbid	-- Only return rows after this dbid, ordered by dbid.
+		after		-- Only return rows after the row with these values of
+					   the orderby columns, followed by its dbid. 
+		columns		-- If given, return only these columns of each row as 
+					   namedtuples, instead of objects.
+		use_cache	-- If False, the result is neither taken from nor 
+					   stored in the cache, e.g. for queries that won't
+					   be repeated.
 		"""
 		table_name = data_class.__tablename__
-		cmd = SQL.MakeSelectCommand(table_name, args[0], orderby)
+		use_cache = use_cache and self.__cacheable__()
+		row_type = None
+		if columns is not None:
+			columns = tuple(columns)
+			row_type = data_class.__sql_plan__.RowType(columns)
+			if row_type is None:
+				return []
+
+		# keyset pagination
+		if after_dbid is not None:
+			orderby = SQL.DbidOrder(orderby)
+			after = ( after_dbid, )
+		if after is not None:
+			keyset = Query.After(orderby, after)
+			args = keyset if args is None else Query.And(args, keyset)
+			orderby = Query.KeysetOrder(orderby)
+
+		if args is None:
+			args = ( "", () )
+		start = self.__clock__()
+		cmd = SQL.MakeSelectCommand(table_name, args[0], orderby, limit, offset, columns)
 		
 		# See if value is already in cache
-		hash = 0
-		if self.use_cache:
-			hash = SQL.CommandHash(cmd, args[1])
-			if hash in self.cache.keys():
-				return self.cache[hash]
+		key = None
+		search_list = None
+		cache_hit = None
+		if use_cache:
+			key = ( "select", table_name, Query.KeyOf(args), orderby, limit, offset, columns )
+			cached = self.cache.Get(key)
+			cache_hit = cached is not None
+			if cached is not None:
+				# copy, so callers can't modify the cached result
+				search_list = cached.copy()
 		
-		cursor = self.connection.cursor()
-		cursor.execute(cmd, args[1])
-		results = cursor.fetchall()
+		objects = 0
+		if search_list is None:
+			generations = self.cache.Generations( ( table_name, ) )
+			search_list = self.__select_rows__(
+				data_class, cmd, tuple(args[1]) + SQL.LimitArgs(limit, offset), row_type
+			)
+			if row_type is None:
+				objects = len(search_list)
+			if use_cache:
+				self.cache.Put(key, search_list.copy(), (table_name,), generations)
+		if start is not None:
+			self.__observe__(start, "Select", data_class, cmd, len(search_list), objects, cache_hit)
+
+		if len(prefetch) > 0 and row_type is None:
+			self.Prefetch(search_list, prefetch)
+		return search_list
+
+	def DbidOrder(orderby:str) -> str:
+		"""
+		Returns the order of rows selected after a dbid, which is by 
+		dbid, with a warning if orderby asks for another one.
+		"""
+		if orderby != "" and Query.ParseOrder(orderby) != [ ( "dbid", False ) ]:
+			print(f"WARNING: rows after a dbid are ordered by dbid, not by {orderby}!")
+		return ""
+
+	def Paginate(self, data_class:type, args=None, orderby="", page_size=100, after=None):
+		"""
+		Returns a Pager over the results of a query. 
+
+		Arguments:
+
+		args 		-- Produced by chaining Query functions, or None to
+					   select all rows.
+		orderby		-- Produced by chaining Query.Order* functions.
+		page_size	-- Number of rows per page.
+		after		-- Pager.after of a previous Pager, to resume from there.
+		"""
+		return Pager(self, data_class, args, orderby, page_size, after)
+
+	def __select_rows__(self, data_class:type, cmd:str, args:tuple, row_type=None) -> list:
+		"""
+		Runs a select command, and returns the rows as objects, or
+		as row_type if it's a projection.
+		"""
+		cursor = self.__reader__().cursor()
+		if row_type is not None:
+			cursor.row_factory = None
+			return list(map(row_type._make, self.__run__(cmd, args, cursor, fetch="all")))
+
+		generation = self.__read_generation__(data_class.__tablename__)
+		results = self.__run__(cmd, args, cursor, fetch="all")
 		search_list = []
 		for result in results:
-			item = self.ProcessRow(data_class, result)
+			item = self.ProcessRow(data_class, result, generation)
 			search_list.append(item)
-		cursor.close()
+		return search_list
+
+	def SelectIter(self, data_class:type, args:tuple, orderby="", batch_size=ITER_BATCH, 
+		use_sharedmemory=True, prefetch=(), columns=None):
+		"""
+		Selects data from the DB, and yields the objects one by one.
+		Rows are fetched batch_size at a time, so only one batch is
+		in memory at once. Result not cached.
+
+		Arguments:
+
+		args 				-- Produced by chaining Query functions, or None
+							   to select all rows.
+		orderby				-- Produced by chaining Query.Order* functions.
+		batch_size			-- Number of rows fetched at once.
+		use_sharedmemory	-- If False, the objects are neither taken from 
+							   nor stored in shared memory.
+		prefetch			-- Names of relations to load for each batch at once.
+		columns				-- If given, yield only these columns of each row
+							   as namedtuples, instead of objects.
+		"""
+		if args is None:
+			args = ( "", () )
+		row_type = None
+		if columns is not None:
+			columns = tuple(columns)
+			row_type = data_class.__sql_plan__.RowType(columns)
+			if row_type is None:
+				return
+		cmd = SQL.MakeSelectCommand(data_class.__tablename__, args[0], orderby, columns=columns)
+		yield from self.__iter_rows__(
+			data_class, cmd, args[1], batch_size, use_sharedmemory, prefetch, row_type
+		)
+
+	def SelectAllIter(self, data_class:type, batch_size=ITER_BATCH, 
+		use_sharedmemory=True, prefetch=(), columns=None):
+		"""
+		Yields all rows of a table from the DB, one by one. See SelectIter.
+		"""
+		yield from self.SelectIter(
+			data_class, None, "", batch_size, use_sharedmemory, prefetch, columns
+		)
+
+	def __iter_rows__(self, data_class:type, cmd:str, args:tuple, batch_size:int,
+		use_sharedmemory:bool, prefetch:tuple, row_type=None):
+		cursor = self.__reader__().cursor()
+		if row_type is not None:
+			cursor.row_factory = None
+		# only the time spent fetching rows is observed, not the caller's
+		start = self.__clock__()
+		observed = start is not None
+		elapsed = 0.0
+		rows = 0
+		generation = self.__read_generation__(data_class.__tablename__)
+		try:
+			self.__run__(cmd, args, cursor)
+			while True:
+				results = cursor.fetchmany(batch_size)
+				rows += len(results)
+				if len(results) == 0:
+					break
+				if row_type is not None:
+					batch = list(map(row_type._make, results))
+				elif use_sharedmemory:
+					batch = [ self.ProcessRow(data_class, result, generation) for result in results ]
+				else:
+					batch = [ SQL.CopyRowToData(data_class, result) for result in results ]
+				if observed:
+					elapsed += perf_counter() - start
+					start = None
+				if len(prefetch) > 0 and row_type is None:
+					self.Prefetch(batch, prefetch)
+				yield from batch
+				if observed:
+					start = perf_counter()
+		finally:
+			cursor.close()
+			if observed:
+				if start is not None:
+					elapsed += perf_counter() - start
+				objects = rows if row_type is None else 0
+				self.__observe__(perf_counter() - elapsed, "SelectIter", data_class, cmd, rows, objects)
+
+	def ToArrays(self, data_class:type, args:tuple, columns=None, orderby="", 
+		batch_size=ITER_BATCH) -> dict:
+		"""
+		Selects data from the DB, and returns it as a dict of NumPy 
+		arrays, one per column, without building any objects. Rows are
+		streamed batch_size at a time into preallocated arrays. Result
+		not cached. Requires NumPy.
+
+		Integer, real, date and timestamp columns are exported to
+		arrays of the matching dtype, and text columns to arrays of
+		objects. References are exported as the dbid of the row they
+		point to (0 if NULL). Custom types are only exported if they
+		were registered with an array_adapter.
+
+		Arguments:
+
+		args 		-- Produced by chaining Query functions, or None to
+					   select all rows.
+		columns		-- Names of the columns to export (default: all of 
+					   them, and the dbid).
+		orderby		-- Produced by chaining Query.Order* functions.
+		batch_size	-- Number of rows fetched at once.
+		"""
+		try:
+			import numpy as np
+		except ImportError:
+			raise ImportError("ToArrays requires NumPy (pip install numpy)") from None
+
+		if args is None:
+			args = ( "", () )
+		plan = data_class.__sql_plan__
+		if columns is None:
+			columns = ( "dbid", ) + plan.columns
+		columns = tuple(columns)
+		if plan.RowType(columns) is None:
+			return {}
+		sql_types = dict(data_class.__sql_columns__)
+		sql_types["dbid"] = "integer"
+		annotations = data_class.__annotations__
+
+		# preallocate the arrays
+		size = self.Count(data_class, args)
+		arrays = {}
+		fillers = []
+		select_terms = []
+		for index, name in enumerate(columns):
+			sql_type = sql_types[name]
+			if sql_type in SQL.ARRAY_DTYPES:
+				dtype = SQL.ARRAY_DTYPES[sql_type]
+				if sql_type == "integer":
+					if annotations.get(name) is bool:
+						dtype = "bool"
+					# NULL integers (e.g. unset references) are exported as 0
+					select_terms.append(f"ifnull({name}, {NULL_INT})")
+				else:
+					select_terms.append(name)
+				arrays[name] = np.empty(size, dtype=dtype)
+				fillers.append( ( index, name, None, None ) )
+			elif sql_type in SQL.TYPE_ARRAYS:
+				adapter, fields = SQL.TYPE_ARRAYS[sql_type]
+				select_terms.append(name)
+				if fields is not None:
+					for field in fields:
+						arrays[f"{name}_{field}"] = np.full(size, np.nan)
+				else:
+					# allocated once we know the length of the values
+					arrays[name] = None
+				fillers.append( ( index, name, adapter, fields ) )
+			else:
+				print(f"WARNING: {name} in {data_class.__name__} can't be exported to an array!")
+				return {}
+
+		cmd = SQL.MakeSelectCommand(
+			data_class.__tablename__, args[0], orderby, limit=size, columns=select_terms
+		)
+		cursor = self.__reader__().cursor()
+		cursor.row_factory = None
+		clock = self.__clock__()
+		start = 0
+		try:
+			self.__run__(cmd, tuple(args[1]) + SQL.LimitArgs(size), cursor)
+			while True:
+				results = cursor.fetchmany(batch_size)
+				if len(results) == 0:
+					break
+				end = start + len(results)
+				values = list(zip(*results))
+				for index, name, adapter, fields in fillers:
+					if adapter is None:
+						arrays[name][start:end] = values[index]
+						continue
+					rows = [ None if v is None else adapter(v) for v in values[index] ]
+					width = next( ( len(row) for row in rows if row is not None ), 0 )
+					if width == 0:
+						continue
+					nan_row = ( np.nan, ) * width
+					block = np.array(
+						[ nan_row if row is None else row for row in rows ], dtype="float64"
+					)
+					if fields is not None:
+						for f, field in enumerate(fields):
+							arrays[f"{name}_{field}"][start:end] = block[:, f]
+					else:
+						if arrays[name] is None:
+							arrays[name] = np.full( ( size, width ), np.nan )
+						arrays[name][start:end] = block
+				start = end
+		finally:
+			cursor.close()
+		if clock is not None:
+			self.__observe__(clock, "ToArrays", data_class, cmd, start)
+
+		for name, array in arrays.items():
+			if array is None:
+				arrays[name] = np.full( ( start, 0 ), np.nan )
+			elif start < size:
+				# rows were deleted while we read them
+				arrays[name] = array[:start]
+		return arrays
+
+	def SelectIn(self, data_class:type, column:str, values, orderby="") -> list:
+		"""
+		Selects the rows whose column is one of values. Values are
+		sent to the DB in chunks of SQL.IN_CHUNK. Result not cached.
 
-		if self.use_cache:
-			self.cache[hash] = search_list
+		Arguments:
 
+		column	-- Name of the column to match.
+		values	-- Iterable of values to match.
+		orderby	-- Produced by chaining Query.Order* functions. Only
+				   applies within each chunk.
+		"""
+		table_name = data_class.__tablename__
+		values = list(values)
+		search_list = []
+		for start in range(0, len(values), SQL.IN_CHUNK):
+			clock = self.__clock__()
+			chunk = values[start:start+SQL.IN_CHUNK]
+			placeholders = ", ".join("?" * len(chunk))
+			cmd = SQL.MakeSelectCommand(table_name, f"{column} in ({placeholders})", orderby)
+			results = self.__select_rows__(data_class, cmd, chunk)
+			if clock is not None:
+				self.__observe__(clock, "SelectIn", data_class, cmd, len(results), len(results))
+			search_list += results
 		return search_list
 
+	def Prefetch(self, items:list, names:tuple):
+		"""
+		Loads relations of many objects of the same class at once,
+		instead of with one query per object when they're accessed.
+
+		Arguments:
+
+		items	-- Objects whose relations to load.
+		names	-- Names of the Reference and List fields to load.
+		"""
+		if len(items) == 0:
+			return
+		data_class = items[0].__class__
+		annotations = data_class.__annotations__
+		with self.__labeled__("Prefetch"):
+			for name in names:
+				origin = get_origin(annotations.get(name))
+				if origin is not None and origin.__name__ == "Reference":
+					child_dc = get_args(annotations[name])[0]
+					self.__prefetch_references__(items, name, child_dc)
+				elif origin is not None and origin.__name__ == "List":
+					child_dc = get_args(annotations[name])[0]
+					self.__prefetch_lists__(items, name, child_dc)
+				else:
+					print(f"WARNING: Can't prefetch {name} in {data_class.__name__}!")
+
+	def __prefetch_references__(self, items:list, name:str, child_dc:type):
+		refs = [ item.__dict__[name] for item in items ]
+		ref_ids = set()
+		for ref in refs:
+			if ref.ref_id != NULL_INT and not ref.__is_current__():
+				ref_ids.add(ref.ref_id)
+		if len(ref_ids) == 0:
+			return
+
+		loaded = {}
+		for obj in self.__owner__(child_dc).SelectIn(child_dc, "dbid", ref_ids):
+			loaded[obj.dbid] = obj
+		for ref in refs:
+			obj = loaded.get(ref.ref_id)
+			if obj is not None:
+				ref.__prefetched__(obj)
+
+	def __prefetch_lists__(self, items:list, name:str, child_dc:type):
+		pending = {}
+		for item in items:
+			my_list = item.__dict__[name]
+			if not my_list.__is_loaded__():
+				pending[item.dbid] = my_list
+		if len(pending) == 0:
+			return
+
+		# load the children of all parents, in list order
+		list_id = SQL.ListIdentifier(items[0].__class__, name)
+		id_key = SQL.MakeListID(list_id)
+		order_key = SQL.MakeListOrder(list_id)
+		children = self.__owner__(child_dc).SelectIn(
+			child_dc, 
+			id_key, 
+			pending.keys(),
+			Query.OrderChain(
+				Query.OrderAscending(id_key), 
+				Query.OrderAscending(order_key)
+			)
+		)
+
+		groups = {}
+		for dbid in pending.keys():
+			groups[dbid] = []
+		for child in children:
+			groups[child.__dict__[id_key]].append(child)
+		for dbid, my_list in pending.items():
+			my_list.__set_loaded__(groups[dbid])
+
 	def Count(self, data_class:type, args:tuple) -> int:
 		"""
 		Returns the number of rows in the table that satisfy the query.
@@ -862,46 +2700,61 @@ class SQL:
 
 		Arguments:
 
-		args 	-- Produced by chaining Query functions.
+		args 	-- Produced by chaining Query functions, or None to count
+				   all rows.
 		"""
+		if args is None:
+			args = ( "", () )
 		table_name = data_class.__tablename__
-		cmd = f"select count(1) from {table_name} where {args[0]}"
-		cursor = self.connection.cursor()
-		cursor.execute(cmd, args[1])
-		size = cursor.fetchone()[0]
-		cursor.close()
+		start = self.__clock__()
+		cmd = SQL.MakeSelectCommand(table_name, args[0], columns=("count(1)",))
+		size = self.__run__(cmd, args[1], self.__reader__().cursor(), fetch="one")[0]
+		if start is not None:
+			self.__observe__(start, "Count", data_class, cmd, 1)
 		return size
 	
-	def SelectAll(self, data_class:type) -> list:
+	def SelectAll(self, data_class:type, prefetch=(), columns=None) -> list:
 		"""
 		Returns all rows of a table from the DB.
 
 		Arguments:
 
-		args 	-- Produced by chaining Query functions.
+		prefetch	-- Names of relations to load for all results at once.
+		columns		-- If given, return only these columns of each row as 
+					   namedtuples, instead of objects.
 		"""
+		if columns is not None:
+			return self.Select(data_class, None, columns=columns)
+
 		table_name = data_class.__tablename__
+		start = self.__clock__()
 		cmd = f"select * from {table_name}"
 
+		use_cache = self.__cacheable__()
 		# See if value is already in cache
-		hash = 0
-		if self.use_cache:
-			hash = SQL.CommandHash(cmd, ())
-			if hash in self.cache.keys():
-				return self.cache[hash]
-
-		cursor = self.connection.cursor()
-		cursor.execute(cmd)
-		results = cursor.fetchall()
-		search_list = []
-		for result in results:
-			item = self.ProcessRow(data_class, result)
-			search_list.append(item)
-		cursor.close()
-
-		if self.use_cache:
-			self.cache[hash] = search_list
-
+		key = None
+		search_list = None
+		cache_hit = None
+		if use_cache:
+			key = ( "all", table_name )
+			cached = self.cache.Get(key)
+			cache_hit = cached is not None
+			if cached is not None:
+				# copy, so callers can't modify the cached result
+				search_list = cached.copy()
+
+		objects = 0
+		if search_list is None:
+			generations = self.cache.Generations( ( table_name, ) )
+			search_list = self.__select_rows__(data_class, cmd, ())
+			objects = len(search_list)
+			if use_cache:
+				self.cache.Put(key, search_list.copy(), (table_name,), generations)
+		if start is not None:
+			self.__observe__(start, "SelectAll", data_class, cmd, len(search_list), objects, cache_hit)
+
+		if len(prefetch) > 0:
+			self.Prefetch(search_list, prefetch)
 		return search_list
 
 	def SelectOne(self, data_class:type, args:tuple) -> list:
@@ -913,26 +2766,34 @@ class SQL:
 		args 	-- Produced by chaining Query functions.
 		"""
 		table_name = data_class.__tablename__
-		cmd = SQL.MakeSelectCommand(table_name, args[0])
+		start = self.__clock__()
+		cmd = SQL.MakeSelectCommand(table_name, args[0], limit=1)
 		
+		use_cache = self.__cacheable__()
 		# See if value is already in cache
-		hash = 0
-		if self.use_cache:
-			hash = SQL.CommandHash(cmd, args[1])
-			if hash in self.cache.keys():
-				return self.cache[hash]
+		key = None
+		cache_hit = None
+		if use_cache:
+			key = ( "one", table_name, Query.KeyOf(args) )
+			cached = self.cache.Get(key)
+			cache_hit = cached is not None
+			if cached is not None:
+				if start is not None:
+					self.__observe__(start, "SelectOne", data_class, cmd, 1, 0, cache_hit)
+				return cached
 		
-		cursor = self.connection.cursor()
-		cursor.execute(cmd, args[1])
-		result = cursor.fetchone()
-		if result == None:
-			return None
-		item = self.ProcessRow(data_class, result)
-		cursor.close()
-
-		if self.use_cache:
-			self.cache[hash] = item
-
+		generations = self.cache.Generations( ( table_name, ) )
+		generation = self.__read_generation__(table_name)
+		result = self.__run__(cmd, tuple(args[1]) + SQL.LimitArgs(1), self.__reader__().cursor(), fetch="one")
+		item = None
+		if result is not None:
+			item = self.ProcessRow(data_class, result, generation)
+			if use_cache:
+				self.cache.Put(key, item, (table_name,), generations)
+
+		if start is not None:
+			found = int(item is not None)
+			self.__observe__(start, "SelectOne", data_class, cmd, found, found, cache_hit)
 		return item
 	
 	def SelectAtIndex(self, data_class:type, index:int) -> object:
@@ -943,27 +2804,35 @@ class SQL:
 
 		index 	-- index of row in table (dbid, or primary key)
 		"""
-		table_name = data_class.__tablename__
-		cmd = f"select * from {table_name} where dbid = ?"
+		plan = data_class.__sql_plan__
+		start = self.__clock__()
+		cmd = plan.select_cmd
 		args = (index,)
+		use_cache = self.__cacheable__()
 		# See if value is already in cache
-		hash = 0
-		if self.use_cache:
-			hash = SQL.CommandHash(cmd, args)
-			if hash in self.cache.keys():
-				return self.cache[hash]
-
-		cursor = self.connection.cursor()
-		cursor.execute(cmd, args )
-		result = cursor.fetchone()
-		if result == None:
-			return None
-		item = self.ProcessRow(data_class, result)
-		cursor.close()
-
-		if self.use_cache:
-			self.cache[hash] = item
-
+		key = None
+		cache_hit = None
+		if use_cache:
+			key = ( "dbid", plan.table_name, index )
+			cached = self.cache.Get(key)
+			cache_hit = cached is not None
+			if cached is not None:
+				if start is not None:
+					self.__observe__(start, "SelectAtIndex", data_class, cmd, 1, 0, cache_hit)
+				return cached
+
+		generations = self.cache.Generations( ( plan.table_name, ) )
+		generation = self.__read_generation__(plan.table_name)
+		result = self.__run__(cmd, args, self.__reader__().cursor(), fetch="one")
+		item = None
+		if result is not None:
+			item = self.ProcessRow(data_class, result, generation)
+			if use_cache:
+				self.cache.Put(key, item, (plan.table_name,), generations)
+
+		if start is not None:
+			found = int(item is not None)
+			self.__observe__(start, "SelectAtIndex", data_class, cmd, found, found, cache_hit)
 		return item
 	
 	def SelectRandom(self, data_class:type, num=1) -> list:
@@ -975,14 +2844,15 @@ class SQL:
 		num 	-- number of rows to return
 		"""
 		table_name = data_class.__tablename__
-		cursor = self.connection.cursor()
-		cursor.execute(
-			f"select * from {table_name} order by random() limit {max(1, int(num))}"
-		)
-		results = cursor.fetchall()
+		start = self.__clock__()
+		cmd = f"select * from {table_name} order by random() limit {max(1, int(num))}"
+		generation = self.__read_generation__(table_name)
+		results = self.__run__(cmd, cursor=self.__reader__().cursor(), fetch="all")
 		search_list = []
 		for result in results:
-			item = self.ProcessRow(data_class, result)
+			item = self.ProcessRow(data_class, result, generation)
 			search_list.append(item)
-		cursor.close()
+		if start is not None:
+			rows = len(search_list)
+			self.__observe__(start, "SelectRandom", data_class, cmd, rows, rows)
 		return search_list
\ No newline at end of file
@@ -1,3 +1,4 @@
+import threading
 from random import choice
 
 from narwhal.sql import SQL, Query
@@ -83,19 +84,112 @@ def test():
 	# Delete the vessel
 	v.Delete()
 
+	# queries on different values have different cache keys
+	assert(Query.KeyOf(Query.Equals("a", 12)) != Query.KeyOf(Query.Equals("a", 21)))
+	assert(
+		Query.KeyOf(Query.And(Query.Equals("a", 1), Query.Equals("b", 2))) != 
+		Query.KeyOf(Query.And(Query.Equals("a", 2), Query.Equals("b", 1)))
+	)
+
+	# a cached query sees rows added after it was cached
+	found = len(Crew.Select(Query.Equals("name", "asdasdafas")))
+	c = Crew()
+	c.name = "asdasdafas"
+	c.Serialize()
+	assert(len(Crew.Select(Query.Equals("name", "asdasdafas"))) == found + 1)
+
+	# rows added in a rolled back transaction don't exist afterwards
+	c = Crew()
+	c.name = "rolled_back"
+	try:
+		with sql.Transaction():
+			c.Serialize()
+			raise RuntimeError
+	except RuntimeError:
+		pass
+	assert(Crew.SelectOne(Query.Equals("name", "rolled_back")) is None)
+	assert("dbid" not in c.__dict__)
+
+	# updates in a rolled back transaction are undone in memory,
+	# and aren't saved by a later update
+	c = Crew()
+	c.name = "not_rolled_back"
+	c.Serialize()
+	try:
+		with sql.Transaction():
+			c.name = "rolled_back_update"
+			c.Serialize()
+			raise RuntimeError
+	except RuntimeError:
+		pass
+	assert(c.name == "not_rolled_back")
+	c.courage = 3
+	c.Serialize()
+	assert(Crew.SelectOne(Query.Equals("name", "rolled_back_update")) is None)
+	assert(Crew.SelectOne(Query.Equals("name", "not_rolled_back")) is c)
+
+	# items deleted in a rolled back transaction stay in their lists
+	v = Vessel()
+	v.name = "Victory"
+	v.v_class = vc
+	for i in range(3):
+		v.crew.append(Crew())
+	v.Serialize()
+	c = v.crew[1]
+	try:
+		with sql.Transaction():
+			c.Delete()
+			raise RuntimeError
+	except RuntimeError:
+		pass
+	assert(len(v.crew) == 3 and v.crew[1] is c)
+	assert(List.ReverseLookup(c, Vessel, "crew") is v)
+
+def test_pool():
+	sql = SQL("test_pool.db", use_cache=True, pool=True)
+	sql.RegisterTables([
+		Crew,
+		VesselClass,
+		Vessel,
+		HistoryString
+	])
+
+	def in_other_thread(fn):
+		result = []
+		thread = threading.Thread(target=lambda : result.append(fn()))
+		thread.start()
+		thread.join()
+		return result[0]
+
+	def count_uncommitted():
+		return len(Crew.Select(Query.Equals("name", "uncommitted")))
+
+	# other threads don't see uncommitted writes, even through the cache
+	found = count_uncommitted()
+	with sql.Transaction():
+		c = Crew()
+		c.name = "uncommitted"
+		c.Serialize()
+		assert(count_uncommitted() == found + 1)
+		assert(in_other_thread(count_uncommitted) == found)
+	assert(in_other_thread(count_uncommitted) == found + 1)
+
 if __name__ == '__main__':
 		SQL.RegisterTypeConversion(
 			Position,
 			adapter 	= Position.SQLAdapter,
 			converter 	= Position.SQLConverter,
-			default 	= Position()
+			default 	= Position(),
+			array_adapter	= lambda p : p.pos,
+			array_fields	= ( "lat", "lng" )
 		)
 
 		SQL.RegisterTypeConversion(
 			FloatArray,
 			adapter 	= FloatArray.SQLAdapter,
 			converter 	= FloatArray.SQLConverter,
-			default 	= FloatArray(32)
+			default 	= FloatArray(32),
+			array_adapter	= lambda p : p.array
 		)
 
 		sql = SQL("test.db", use_cache=True)
@@ -107,6 +201,7 @@ if __name__ == '__main__':
 		])
 
 		test()
+		test_pool()
 
 		# size of data stored in memory from the db
 		print(f"Size of DB data stored in memory: {sql.SharedMemorySize()} bytes")
\ No newline at end of file